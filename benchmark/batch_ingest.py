@@ -0,0 +1,82 @@
+"""
+Measures how many items per second the request processor can ingest at different batch sizes.
+
+    python -m benchmark.batch_ingest [item_count] [batch_size ...]
+"""
+import sys, time, tempfile, shutil, base64
+from os.path import join
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from common.crypto_utils import sign_data_with_key
+from common.logging import LogLevel
+from server.message_store import MessageStore
+from server.request_processor import RequestProcessor
+from server.storage.log_storage import LogStorage
+from server.work_queue import WorkQueue, RequestStatus
+
+ENCODING = 'utf-8'
+CLIENT_ID = 'benchmark'
+DEFAULT_ITEM_COUNT = 5000
+DEFAULT_BATCH_SIZES = [1, 10, 100, 1000]
+
+
+def build_items(item_count):
+    key = rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=2048)
+    public_key = key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode(ENCODING)
+
+    def sign(data):
+        return base64.standard_b64encode(sign_data_with_key(data, key)).decode(ENCODING)
+
+    registration_data = {'publicKey': public_key}
+    registration = {'type': 'registration', 'requestId': 'registration', 'clientId': CLIENT_ID, 'publicKey': public_key,
+                    'signature': sign(registration_data), 'data': registration_data}
+
+    publication_data = {'message': 'benchmark message'}
+    publication_signature = sign(publication_data)
+    publications = [{'type': 'publication', 'requestId': str(n), 'clientId': CLIENT_ID, 'signature': publication_signature,
+                     'data': publication_data} for n in range(item_count)]
+
+    return registration, publications
+
+
+def run(registration, publications, batch_size):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        message_store = MessageStore(LogStorage(dir_path=join(temp_dir, 'store'), legacy_file_path=''))
+        work_queue = WorkQueue()
+        RequestProcessor(work_queue, message_store, batch_size=batch_size, batch_linger=0.005).start()
+
+        work_queue.add(registration)
+        while work_queue.query(registration['requestId']) == RequestStatus.PENDING:
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        for item in publications:
+            work_queue.add(dict(item))
+        work_queue.queue.join()
+        elapsed = time.perf_counter() - start
+
+        failures = sum(1 for item in publications if work_queue.query(item['requestId']) != RequestStatus.SUCCESS)
+        message_store.close()
+        return elapsed, failures
+
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    LogLevel.currentLevel = LogLevel.ERROR
+    item_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ITEM_COUNT
+    batch_sizes = [int(arg) for arg in sys.argv[2:]] or DEFAULT_BATCH_SIZES
+
+    registration, publications = build_items(item_count)
+    print('{:>10} {:>12} {:>10}'.format('batch size', 'items/sec', 'failures'))
+    for batch_size in batch_sizes:
+        elapsed, failures = run(registration, publications, batch_size)
+        print('{:>10} {:>12.0f} {:>10}'.format(batch_size, len(publications) / elapsed, failures))
@@ -0,0 +1,72 @@
+"""
+Measures how long the message store takes to open over a large log, replaying the whole log compared with starting
+from a state snapshot and replaying only the messages added after it.
+
+    python -m benchmark.cold_start [message_count] [tail_count]
+"""
+import sys, time, tempfile, shutil, resource
+from os.path import join
+
+from common.logging import LogLevel
+from server.checkpoint import Checkpointer
+from server.message_store import MessageStore
+from server.storage.log_storage import LogStorage
+from server.storage.state_snapshot_storage import StateSnapshotStorage
+
+DEFAULT_MESSAGE_COUNT = 1000000
+DEFAULT_TAIL_COUNT = 1000
+CLIENT_COUNT = 1000
+CHUNK_SIZE = 10000
+INDEXED_PATHS = ['data.message']
+
+
+def build_message(n):
+    client_id = 'client-{}'.format(n % CLIENT_COUNT)
+    if n < CLIENT_COUNT:
+        return {'type': 'registration', 'requestId': str(n), 'clientId': client_id, 'signature': 'x' * 344,
+                'publicKey': 'key', 'data': {'publicKey': 'key'}}
+    return {'type': 'publication', 'requestId': str(n), 'clientId': client_id, 'signature': 'x' * 344,
+            'data': {'message': 'benchmark message {}'.format(n)}}
+
+
+def write_log(dir_path, start, count):
+    storage = LogStorage(dir_path=dir_path, legacy_file_path='')
+    storage.open()
+    for chunk_start in range(start, start + count, CHUNK_SIZE):
+        storage.append([build_message(n) for n in range(chunk_start, min(chunk_start + CHUNK_SIZE, start + count))])
+    storage.close()
+
+
+def open_store(dir_path, state_snapshots):
+    start = time.perf_counter()
+    message_store = MessageStore(LogStorage(dir_path=dir_path, legacy_file_path=''), indexed_paths=INDEXED_PATHS,
+                                 checkpointer=Checkpointer(), state_snapshots=state_snapshots)
+    return message_store, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    LogLevel.currentLevel = LogLevel.ERROR
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MESSAGE_COUNT
+    tail_count = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TAIL_COUNT
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        dir_path = join(temp_dir, 'store')
+        write_log(dir_path, 0, message_count - tail_count)
+
+        message_store, elapsed = open_store(dir_path, StateSnapshotStorage(dir_path))
+        print('{:<30} {:>8.2f}s'.format('full replay', elapsed))
+
+        start = time.perf_counter()
+        message_store.save_state()
+        print('{:<30} {:>8.2f}s'.format('save snapshot', time.perf_counter() - start))
+        message_store.close()
+
+        write_log(dir_path, message_count - tail_count, tail_count)
+        message_store, elapsed = open_store(dir_path, StateSnapshotStorage(dir_path))
+        print('{:<30} {:>8.2f}s'.format('snapshot + {} message tail'.format(tail_count), elapsed))
+        message_store.close()
+        print('{:<30} {:>8.0f}MB'.format('peak RSS', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    finally:
+        shutil.rmtree(temp_dir)
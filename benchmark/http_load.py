@@ -0,0 +1,88 @@
+"""
+Measures request throughput of the web server in each serving mode, at several levels of client concurrency.
+Every client thread keeps its own HTTP session, so connections are reused where the server allows it.
+
+    python -m benchmark.http_load [seconds_per_level] [concurrency ...]
+"""
+import sys, time, tempfile, shutil, threading, socket
+from os.path import join
+
+import requests
+
+from common.logging import LogLevel
+from server.message_store import MessageStore
+from server.storage.log_storage import LogStorage
+from server.web_server import WebServer, SINGLE_THREADED, THREADED
+from server.work_queue import WorkQueue
+
+HOST = '127.0.0.1'
+PORT = 5050
+MESSAGE_COUNT = 1000
+DEFAULT_DURATION = 3
+DEFAULT_CONCURRENCY = [1, 4, 16, 64]
+QUERY_URL = 'http://{}:{}/api/query?type=publication&limit=20'.format(HOST, PORT)
+
+
+def wait_for_port_state(is_open):
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            if (sock.connect_ex((HOST, PORT)) == 0) == is_open:
+                return
+        time.sleep(0.1)
+
+
+def run_clients(concurrency, duration):
+    counts = [0] * concurrency
+    errors = [0] * concurrency
+    deadline = time.perf_counter() + duration
+
+    def client(n):
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            try:
+                if session.get(QUERY_URL, timeout=10).status_code == 200:
+                    counts[n] += 1
+                else:
+                    errors[n] += 1
+            except requests.RequestException:
+                errors[n] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start), sum(errors)
+
+
+def run(mode, concurrency_levels, duration, message_store):
+    web_server = WebServer(HOST, PORT, WorkQueue(), message_store, mode=mode, thread_count=max(concurrency_levels))
+    threading.Thread(target=web_server.start, daemon=True).start()
+    wait_for_port_state(True)
+    try:
+        return [run_clients(concurrency, duration) for concurrency in concurrency_levels]
+    finally:
+        web_server.stop()
+        wait_for_port_state(False)
+
+
+if __name__ == '__main__':
+    LogLevel.currentLevel = LogLevel.ERROR
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_DURATION
+    concurrency_levels = [int(arg) for arg in sys.argv[2:]] or DEFAULT_CONCURRENCY
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        message_store = MessageStore(LogStorage(dir_path=join(temp_dir, 'store'), legacy_file_path=''))
+        for n in range(MESSAGE_COUNT):
+            message_store.add({'type': 'publication', 'requestId': str(n), 'clientId': 'benchmark', 'signature': '', 'data': {'message': str(n)}})
+
+        print('{:>10} {:>12} {:>12} {:>8}'.format('mode', 'concurrency', 'requests/sec', 'errors'))
+        for mode in [SINGLE_THREADED, THREADED]:
+            for concurrency, (throughput, errors) in zip(concurrency_levels, run(mode, concurrency_levels, duration, message_store)):
+                print('{:>10} {:>12} {:>12.0f} {:>8}'.format(mode, concurrency, throughput, errors))
+        message_store.close()
+
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,34 @@
+"""
+Measures key generation, signing and verification throughput for each of the supported key algorithms, signing a
+typical publication's data.
+
+    python -m benchmark.signature_schemes [operation_count]
+"""
+import sys, time
+
+from common.crypto_utils import KEY_ALGORITHMS, generate_private_key, sign_data_with_key, verify_signature
+
+DEFAULT_OPERATION_COUNT = 1000
+KEYGEN_COUNT = 20
+DATA = {'message': 'benchmark message'}
+
+
+def rate(fn, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    operation_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_OPERATION_COUNT
+
+    print('{:<10} {:>12} {:>12} {:>12} {:>10}'.format('algorithm', 'keygen/s', 'sign/s', 'verify/s', 'sig bytes'))
+    for algorithm in KEY_ALGORITHMS:
+        keygen_rate = rate(lambda: generate_private_key(algorithm), KEYGEN_COUNT)
+        key = generate_private_key(algorithm)
+        public_key = key.public_key()
+        signature = sign_data_with_key(DATA, key)
+        sign_rate = rate(lambda: sign_data_with_key(DATA, key), operation_count)
+        verify_rate = rate(lambda: verify_signature(DATA, signature, public_key), operation_count)
+        print('{:<10} {:>12.0f} {:>12.0f} {:>12.0f} {:>10}'.format(algorithm, keygen_rate, sign_rate, verify_rate, len(signature)))
@@ -1,23 +1,78 @@
-import json, os.path
+import json, os, time
 
 
 class PublicKeyCache:
+    """
+    Public keys of other clients, taken from their registrations on the server. The file is read once when the cache
+    is created, and changes are only written back by `flush`, which replaces the whole file in one step so an
+    interrupted write never leaves it half-written.
+
+    Entries older than `ttl` seconds are ignored, and once there are more than `max_entries` the oldest are dropped.
+    The cache also records the id of the server's message list the keys came from, and is emptied if that changes.
+    """
     file_path = 'public_key_cache.json'
 
-    def __init__(self):
-        if os.path.exists(PublicKeyCache.file_path):
-            with open(PublicKeyCache.file_path, 'r') as file:
-                self.cache = json.load(file)
-        else:
-            self.cache = {}
+    def __init__(self, file_path=None, ttl=7 * 24 * 60 * 60, max_entries=10000):
+        self.file_path = file_path or PublicKeyCache.file_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store_id = None
+        self.entries = {}
+        self.dirty = False
+        self._load()
 
     def add(self, id, public_key):
-        self.cache[id] = public_key
-        self._save()
+        self.entries[id] = {'publicKey': public_key, 'added': time.time()}
+        self.dirty = True
 
     def get(self, id):
-        return self.cache.get(id, None)
+        entry = self.entries.get(id)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            del self.entries[id]
+            self.dirty = True
+            return None
+        return entry['publicKey']
+
+    def missing(self, ids):
+        return sorted(set(id for id in ids if self.get(id) is None))
+
+    def set_store_id(self, store_id):
+        if store_id is None or store_id == self.store_id:
+            return
+        if self.store_id is not None:
+            self.entries = {}
+        self.store_id = store_id
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty:
+            return
+        if len(self.entries) > self.max_entries:
+            newest = sorted(self.entries.items(), key=lambda item: item[1]['added'])[-self.max_entries:]
+            self.entries = dict(newest)
 
-    def _save(self):
-        with open(PublicKeyCache.file_path, 'w') as file:
-            json.dump(self.cache, file, indent=4)
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'storeId': self.store_id, 'keys': self.entries}, file, indent=4)
+        os.replace(temp_path, self.file_path)
+        self.dirty = False
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry['added'] > self.ttl
+
+    def _load(self):
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, 'r') as file:
+            saved = json.load(file)
+
+        if 'keys' in saved:
+            self.store_id = saved['storeId']
+            self.entries = saved['keys']
+        else:
+            # older cache files were a plain mapping of id to public key
+            now = time.time()
+            self.entries = {id: {'publicKey': public_key, 'added': now} for id, public_key in saved.items()}
+            self.dirty = True
@@ -1,61 +1,88 @@
+import json, socket, base64
+from concurrent.futures import ProcessPoolExecutor
 from os import makedirs, listdir, remove
-from os.path import join, isfile
+from os.path import join, isfile, exists
 from common.logging import log, LogLevel
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
+from common.crypto_utils import generate_private_key, RSA, KEY_ALGORITHMS
+
+ENCODING = 'utf-8'
+AGENT_SOCKET_FILE_NAME = 'agent.sock'
+AGENT_TIMEOUT = 5
+BULK_CHUNK_SIZE = 16
+
+
+def private_key_pem(key, key_password):
+    encryption_algorithm=serialization.NoEncryption() if key_password is None else serialization.BestAvailableEncryption(key_password.encode())
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=encryption_algorithm
+    )
+
+
+def generate_private_key_pem(algorithm, key_password):
+    return private_key_pem(generate_private_key(algorithm), key_password)
 
 
 class IdManager:
+    """
+    Manages the private keys held in `key_dir`, one .pem file per id. The ids are found by listing the directory, and
+    each key is only read (and decrypted, if there is a `key_password`) the first time `get_key` is called for it.
+
+    If a key agent is running for the directory (see client/key_agent.py), keys are taken from it instead, so that
+    each command does not have to decrypt them again.
+    """
     key_extension = '.pem'
 
-    def __init__(self, key_dir='./keys', key_password=None):
+    def __init__(self, key_dir='./keys', key_password=None, use_agent=True):
         self.key_dir = key_dir
         self.key_password = key_password
         makedirs(self.key_dir, exist_ok=True)
-        self.__load_keys()
-
-    def __load_keys(self):
+        self.names = [file_name[:-len(IdManager.key_extension)] for file_name in listdir(self.key_dir) if file_name.endswith(IdManager.key_extension)]
         self.keys = {}
-        for file_name in listdir(self.key_dir):
-            if file_name.endswith(IdManager.key_extension):
-                key_name = file_name[:-len(IdManager.key_extension)]
-                key_file_name = join(self.key_dir, file_name)
-                with open(key_file_name, "rb") as key_file:
-                    private_key = serialization.load_pem_private_key(
-                        key_file.read(),
-                        password=None if self.key_password is None else self.key_password.encode(),
-                        backend=default_backend()
-                    )
-                    self.keys[key_name] = private_key
-                    log(LogLevel.DEBUG, 'Loaded key {}'.format(key_name))
-
-    def create(self, name):
-        if name in self.keys:
+        agent_socket_path = join(self.key_dir, AGENT_SOCKET_FILE_NAME)
+        self.agent = KeyAgentClient(agent_socket_path) if use_agent and exists(agent_socket_path) else None
+
+    def create(self, name, algorithm=RSA):
+        if name in self.names:
             raise ValueError("The id '{}' already exists".format(name))
 
-        key =rsa.generate_private_key(
-            backend=default_backend(),
-            public_exponent=65537,
-            key_size=2048
-        )
-        encryption_algorithm=serialization.NoEncryption() if self.key_password is None else serialization.BestAvailableEncryption(self.key_password.encode())
-        pem = key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=encryption_algorithm
-        )
-        file_name = join(self.key_dir, name + IdManager.key_extension)
-        with open(file_name, 'wb') as key_file:
-            key_file.write(pem)
+        key = generate_private_key(algorithm)
+        self._write_key_file(name, private_key_pem(key, self.key_password))
+        self.keys[name] = key
+
+    def create_many(self, names, algorithm=RSA, workers=None):
+        """
+        Creates a key for each of the names that is not already in use, generating (and encrypting) the keys in a pool
+        of `workers` processes. Returns the names that were created and those that already existed.
+        """
+        if algorithm not in KEY_ALGORITHMS:
+            raise ValueError("Unknown key algorithm '{}', expected one of {}".format(algorithm, ', '.join(KEY_ALGORITHMS)))
+
+        used_names = set(self.names)
+        new_names = []
+        already_existed = []
+        for name in names:
+            (already_existed if name in used_names else new_names).append(name)
+            used_names.add(name)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pems = executor.map(generate_private_key_pem, [algorithm] * len(new_names), [self.key_password] * len(new_names), chunksize=BULK_CHUNK_SIZE)
+            for name, pem in zip(new_names, pems):
+                self._write_key_file(name, pem)
+        return new_names, already_existed
 
     def list(self):
-        return self.keys.keys()
+        return list(self.names)
 
     def delete(self, name):
-        pem_file_path = '{}/{}{}'.format(self.key_dir, name, IdManager.key_extension)
+        pem_file_path = self.key_file_path(name)
         if isfile(pem_file_path):
             remove(pem_file_path)
+            self.names.remove(name)
+            self.keys.pop(name, None)
             log(LogLevel.DEBUG, 'Removed id {}'.format(name))
             return True
         else:
@@ -63,7 +90,62 @@ class IdManager:
             return False
 
     def get_key(self, name):
-        if name not in self.keys:
+        if name not in self.names:
             raise ValueError("The id '{}' does not exist".format(name))
 
+        if name not in self.keys:
+            self.keys[name] = self._load_key(name)
         return self.keys[name]
+
+    def key_file_path(self, name):
+        return join(self.key_dir, name + IdManager.key_extension)
+
+    def _write_key_file(self, name, pem):
+        with open(self.key_file_path(name), 'wb') as key_file:
+            key_file.write(pem)
+        self.names.append(name)
+
+    def _load_key(self, name):
+        if self.agent:
+            key = self.agent.get_key(name)
+            if key is not None:
+                log(LogLevel.DEBUG, 'Got key {} from key agent'.format(name))
+                return key
+
+        with open(self.key_file_path(name), "rb") as key_file:
+            private_key = serialization.load_pem_private_key(
+                key_file.read(),
+                password=None if self.key_password is None else self.key_password.encode(),
+                backend=default_backend()
+            )
+        log(LogLevel.DEBUG, 'Loaded key {}'.format(name))
+        return private_key
+
+
+class KeyAgentClient:
+    """
+    Asks a key agent for a decrypted key. Each request is a line of JSON giving the id, and the agent replies with a
+    line of JSON holding either the key, as unencrypted base64 DER, or an error.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def get_key(self, name):
+        """
+        Returns the key, or None if the agent is not running or cannot supply it.
+        """
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(AGENT_TIMEOUT)
+                sock.connect(self.socket_path)
+                sock.sendall((json.dumps({'name': name}) + '\n').encode(ENCODING))
+                with sock.makefile('rb') as reader:
+                    response = json.loads(reader.readline())
+        except (OSError, ValueError) as e:
+            log(LogLevel.DEBUG, 'Unable to use key agent at {} - {}'.format(self.socket_path, e))
+            return None
+
+        if 'error' in response:
+            log(LogLevel.WARN, 'Key agent could not supply key {} - {}'.format(name, response['error']))
+            return None
+        return serialization.load_der_private_key(base64.standard_b64decode(response['key']), password=None, backend=default_backend())
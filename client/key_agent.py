@@ -0,0 +1,96 @@
+"""
+Holds decrypted private keys in memory and hands them to IdManager over a unix socket in the key directory, so that
+commands run one after another don't each have to read and decrypt the key files again. Each key is decrypted the
+first time it is asked for, and again only if its file changes. The socket is created with mode 0600, so only the
+user running the agent can connect to it.
+
+    python -m client.key_agent [key_dir]
+
+The password for the key files is read from the terminal when the agent starts (leave it empty if they are not
+encrypted). The agent runs until it is interrupted, and removes the socket when it stops.
+"""
+import os, sys, json, base64, threading, socketserver, getpass
+from os.path import join, exists
+from cryptography.hazmat.primitives import serialization
+from common.logging import log, LogLevel
+from .identity_manager import IdManager, AGENT_SOCKET_FILE_NAME
+
+ENCODING = 'utf-8'
+
+
+class KeyAgent:
+    def __init__(self, key_dir='./keys', key_password=None):
+        self.key_dir = key_dir
+        self.key_password = key_password
+        self.socket_path = join(key_dir, AGENT_SOCKET_FILE_NAME)
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        if exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        agent = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write((json.dumps(agent._handle_request(self.rfile.readline())) + '\n').encode(ENCODING))
+
+        previous_umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        finally:
+            os.umask(previous_umask)
+        os.chmod(self.socket_path, 0o600)
+        self.server.daemon_threads = True
+        log(LogLevel.INFO, 'Key agent listening on {}'.format(self.socket_path))
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _handle_request(self, request_line):
+        try:
+            name = json.loads(request_line)['name']
+            return {'key': base64.standard_b64encode(self._get_key_bytes(name)).decode(ENCODING)}
+        except Exception as e:
+            return {'error': str(e)}
+
+    def _get_key_bytes(self, name):
+        id_manager = IdManager(self.key_dir, self.key_password, use_agent=False)
+        if name not in id_manager.names:
+            raise ValueError("The id '{}' does not exist".format(name))
+
+        # the key is decrypted again if the id has been deleted and recreated since it was last asked for
+        file_stat = os.stat(id_manager.key_file_path(name))
+        version = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+        with self.lock:
+            cached = self.keys.get(name)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        key_bytes = id_manager.get_key(name).private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        with self.lock:
+            self.keys[name] = (version, key_bytes)
+        return key_bytes
+
+
+if __name__ == '__main__':
+    key_agent = KeyAgent(sys.argv[1] if len(sys.argv) > 1 else './keys', getpass.getpass('Key password: ') or None)
+    key_agent.start()
+    try:
+        key_agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        key_agent.stop()
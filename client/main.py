@@ -1,33 +1,94 @@
-import sys, json
+import sys, json, time, asyncio
 from requests.exceptions import HTTPError, ConnectionError
 
 from client.client_cache import PublicKeyCache
-from common.crypto_utils import verify_signature
+from common.crypto_utils import verify_signature, verify_batch_signature
+from common.checkpoint import verify_checkpoints, verify_inclusion_proof, CHECKPOINT_TYPE
 from .identity_manager import IdManager
-from .server_interface import ServerInterface
+from .server_interface import ServerInterface, AsyncServerInterface
+from .replica import LocalReplica
 from common.logging import log, LogLevel
 
 SERVER_HOST = 'localhost'
 SERVER_PORT = 5000
+PREFETCH_BATCH_SIZE = 100
+REGISTER_BULK_WINDOW = 32
+MAX_FAILURES_SHOWN = 10
+
+server_interface = None
+public_key_cache = None
+
+
+def get_server():
+    global server_interface
+    if server_interface is None:
+        server_interface = ServerInterface(SERVER_HOST, SERVER_PORT)
+    return server_interface
+
+
+def get_public_key_cache():
+    global public_key_cache
+    if public_key_cache is None:
+        public_key_cache = PublicKeyCache()
+    return public_key_cache
+
+
+def registration_signature_ok(registration):
+    return verify_signature(registration['data'], registration['signature'], registration['publicKey'])
 
 
 def get_public_key_for_id(id):
-    cache = PublicKeyCache()
+    cache = get_public_key_cache()
+    server = get_server()
+    cache.set_store_id(server.store_id)
     if not cache.get(id):
-        server = ServerInterface(SERVER_HOST, SERVER_PORT)
         id_details = server.query_messages([('type', 'registration'), ('clientId', id)])
         if not id_details:
             raise ValueError('No id {} was found on the server'.format(id))
-        if not verify_signature(id_details[0]['data'], id_details[0]['signature'], id_details[0]['publicKey']):
+        if not registration_signature_ok(id_details[0]):
             raise ValueError('Invalid signature in registration details for {}'.format(id))
         cache.add(id, id_details[0]['publicKey'])
 
     return cache.get(id)
 
+def prefetch_public_keys(messages):
+    """
+    Fetches the registrations for all the clients that sent `messages` and are not yet in the cache, using one query
+    for every PREFETCH_BATCH_SIZE clients rather than one each.
+    """
+    cache = get_public_key_cache()
+    server = get_server()
+    cache.set_store_id(server.store_id)
+    missing_ids = cache.missing(msg['clientId'] for msg in messages if msg['type'] != CHECKPOINT_TYPE)
+    for i in range(0, len(missing_ids), PREFETCH_BATCH_SIZE):
+        criteria = [('type', 'registration')] + [('clientId', id) for id in missing_ids[i:i + PREFETCH_BATCH_SIZE]]
+        for registration in server.query_messages(criteria):
+            # registrations with bad signatures are left out, so that get_public_key_for_id reports them
+            if not cache.get(registration['clientId']) and registration_signature_ok(registration):
+                cache.add(registration['clientId'], registration['publicKey'])
+
 def message_signature_ok(msg):
+    # hash records are not signed, they are checked against the rest of the list by server.verify-chain
+    if msg['type'] == CHECKPOINT_TYPE:
+        return True
     public_key = get_public_key_for_id(msg['clientId'])
+    if 'batch' in msg:
+        return verify_batch_signature(msg['data'], msg['batch'], msg['signature'], public_key)
     return verify_signature(msg['data'], msg['signature'], public_key)
 
+def read_lines(file_name):
+    if file_name == '-':
+        return [line.rstrip('\n') for line in sys.stdin if line.strip()]
+    with open(file_name, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+def bulk_summary(action, succeeded, total, elapsed, failures):
+    lines = ['{} {} of {} ids in {:.1f}s ({:.0f}/s), {} failed'.format(action, succeeded, total, elapsed, succeeded / elapsed if elapsed else 0, len(failures))]
+    lines += ['- {}: {}'.format(name, reason) for name, reason in failures[:MAX_FAILURES_SHOWN]]
+    if len(failures) > MAX_FAILURES_SHOWN:
+        lines.append('- ... and {} more'.format(len(failures) - MAX_FAILURES_SHOWN))
+    return '\n'.join(lines)
+
 def process_command(cmd, opts):
     def check_opt_count(expected_opt_count):
         if len(opts) != expected_opt_count:
@@ -38,12 +99,25 @@ def process_command(cmd, opts):
 
     try:
         if cmd == 'id.create':
-            check_opt_count(1)
+            # the key algorithm is optional
+            if len(opts) != 2:
+                check_opt_count(1)
             id = opts[0]
             id_manager = IdManager()
-            id_manager.create(id)
+            id_manager.create(id, *opts[1:])
             return build_result(True, "New id '{}' created".format(id))
 
+        elif cmd == 'id.create-bulk':
+            # the key algorithm is optional
+            if len(opts) != 2:
+                check_opt_count(1)
+            names = read_lines(opts[0])
+            id_manager = IdManager()
+            start = time.perf_counter()
+            created, already_existed = id_manager.create_many(names, *opts[1:])
+            failures = [(name, 'already exists') for name in already_existed]
+            return build_result(not failures, bulk_summary('Created', len(created), len(names), time.perf_counter() - start, failures))
+
         elif cmd == 'id.list':
             check_opt_count(0)
             id_manager = IdManager()
@@ -64,10 +138,27 @@ def process_command(cmd, opts):
             id = opts[0]
             id_manager = IdManager()
             private_key = id_manager.get_key(id)
-            server = ServerInterface(SERVER_HOST, SERVER_PORT)
+            server = get_server()
             result = server.register(id, private_key)
             return build_result(True, "Registration request for id '{}' was accepted by the server [{}]".format(id, result['requestId']))
 
+        elif cmd == 'server.register-bulk':
+            check_opt_count(1)
+            names = read_lines(opts[0])
+            id_manager = IdManager()
+            server = AsyncServerInterface(ServerInterface(SERVER_HOST, SERVER_PORT, pool_size=REGISTER_BULK_WINDOW))
+            start = time.perf_counter()
+            try:
+                statuses = asyncio.run(server.register_many(names, id_manager.get_key, REGISTER_BULK_WINDOW))
+            finally:
+                server.close()
+                server.server_interface.close()
+            elapsed = time.perf_counter() - start
+
+            failures = [(name, status if isinstance(status, Exception) else status['description'])
+                        for name, status in zip(names, statuses) if isinstance(status, Exception) or status['status'] != 'SUCCESS']
+            return build_result(not failures, bulk_summary('Registered', len(names) - len(failures), len(names), elapsed, failures))
+
         elif cmd == 'server.publish':
             check_opt_count(2)
             id = opts[0]
@@ -75,24 +166,57 @@ def process_command(cmd, opts):
             private_key = id_manager.get_key(id)
 
             message = opts[1]
-            server = ServerInterface(SERVER_HOST, SERVER_PORT)
+            server = get_server()
             result = server.publish(id, private_key, message)
             return build_result(True, "Publication request for id '{}' was accepted by the server [{}]".format(id, result['requestId']))
 
+        elif cmd == 'server.publish-batch':
+            check_opt_count(2)
+            id = opts[0]
+            id_manager = IdManager()
+            private_key = id_manager.get_key(id)
+
+            messages = read_lines(opts[1])
+            server = get_server()
+            statuses = server.publish_batch(id, private_key, messages)
+            failures = [status for status in statuses if status['status'] != 'SUCCESS']
+            if failures:
+                return build_result(False, "{} of {} batches for id '{}' were rejected by the server - {}".format(
+                    len(failures), len(statuses), id, failures[0]['description']))
+            return build_result(True, "{} messages in {} batches for id '{}' were accepted by the server".format(len(messages), len(statuses), id))
+
         elif cmd == 'server.status':
             check_opt_count(1)
             request_id = opts[0]
-            server = ServerInterface(SERVER_HOST, SERVER_PORT)
+            server = get_server()
             status = server.query_status(request_id)
             return build_result(True, "Status of request '{}' was {}".format(request_id, status))
 
         elif cmd == 'server.query':
-            server = ServerInterface(SERVER_HOST, SERVER_PORT)
+            server = get_server()
             key_value_pairs = [pair.split('=') for pair in opts]
-            matches = [msg for msg in server.query_messages(key_value_pairs) if message_signature_ok(msg)]
+            replica = LocalReplica()
+            replica.sync(server, message_signature_ok, prefetch_public_keys)
+            matches = replica.query(key_value_pairs)
 
             return build_result(True, '\n'.join(['{} matches found'.format(len(matches))] + [format_message(msg) for msg in matches]))
 
+        elif cmd == 'server.verify':
+            check_opt_count(1)
+            request_id = opts[0]
+            server = get_server()
+            proof = server.get_proof(request_id)
+            verify_inclusion_proof(proof, server.get_server_key())
+            if not message_signature_ok(proof['record']):
+                return build_result(False, "Message '{}' is included in the log but its signature is not valid".format(request_id))
+            return build_result(True, "Message '{}' is included in the log at position {} of {}".format(request_id, proof['index'], proof['treeHead']['size']))
+
+        elif cmd == 'server.verify-chain':
+            check_opt_count(0)
+            server = get_server()
+            record_count, checkpoint_count, covered_count = verify_checkpoints(server.iter_messages([]))
+            return build_result(True, 'Verified {} hash records covering {} of {} records'.format(checkpoint_count, covered_count, record_count))
+
         else:
             return build_result(True, "Unrecognised command: '{}'".format(cmd))
 
@@ -122,6 +246,8 @@ def process_args(args):
         show_usage()
     else:
         result = process_command(args[1], args[2:])
+        if public_key_cache is not None:
+            public_key_cache.flush()
         if result['ok']:
             log(LogLevel.INFO, result['message'])
         else:
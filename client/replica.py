@@ -0,0 +1,115 @@
+import json, os
+from os.path import exists
+from common.checkpoint import ChainState
+from common.logging import log, LogLevel
+from .server_interface import StoreChangedError
+
+ENCODING = 'utf-8'
+
+
+def get_path_value(message, key_path):
+    value = message
+    for key_part in key_path.split('.'):
+        if not isinstance(value, dict) or key_part not in value:
+            return None
+        value = value[key_part]
+    return value
+
+
+class LocalReplica:
+    """
+    A local copy of the server's message list. Each sync only fetches the messages added since the last one, checks
+    any hash records among them against the hash chain and verifies each message's signature once, storing the result
+    alongside the message, so queries can then be answered locally.
+
+    Messages are held one per line in `file_path`, and `meta_file_path` records how many of those lines are complete,
+    the id of the server's message list they came from and the state of the hash chain. If the server's list is
+    replaced, the replica is discarded and built again.
+    """
+    file_path = 'replica.jsonl'
+    meta_file_path = 'replica.meta.json'
+
+    def __init__(self, file_path=None, meta_file_path=None):
+        self.file_path = file_path or LocalReplica.file_path
+        self.meta_file_path = meta_file_path or LocalReplica.meta_file_path
+        self.records = []
+        self.store_id = None
+        self.chain = ChainState()
+        self._load()
+
+    def sync(self, server, verify, prefetch=None):
+        """
+        Fetches new messages from the server, passing each one to `verify` to check its signature. If given,
+        `prefetch` is called once with all the new messages before any of them are verified. Returns the number of
+        new messages.
+        """
+        try:
+            return self._sync(server, verify, prefetch)
+        except StoreChangedError as e:
+            log(LogLevel.INFO, '{}, discarding the local replica'.format(e))
+            self._reset()
+            return self._sync(server, verify, prefetch)
+
+    def query(self, key_value_pairs):
+        return [record['message'] for record in self.records if record['verified'] and
+                all(get_path_value(record['message'], key) == value for key, value in key_value_pairs)]
+
+    def _sync(self, server, verify, prefetch):
+        chain = self.chain.copy()
+        new_messages = []
+        after = len(self.records) - 1 if self.records else None
+        for message in server.iter_messages([], after, self.store_id):
+            chain.check(message)
+            chain.add(message)
+            new_messages.append(message)
+
+        if prefetch and new_messages:
+            prefetch(new_messages)
+        new_records = [{'message': message, 'verified': bool(verify(message))} for message in new_messages]
+        if new_records or server.store_id != self.store_id:
+            self._save(new_records, server.store_id, chain)
+        return len(new_records)
+
+    def _load(self):
+        if not exists(self.meta_file_path) or not exists(self.file_path):
+            self._reset()
+            return
+
+        with open(self.meta_file_path, 'r') as file:
+            meta = json.load(file)
+        self.store_id = meta['storeId']
+        self.chain = ChainState.from_dict(meta['chain'])
+
+        # lines after the last complete sync are left over from one that was interrupted
+        valid_length = 0
+        with open(self.file_path, 'rb') as file:
+            for line in file:
+                if len(self.records) == meta['count']:
+                    break
+                self.records.append(json.loads(line))
+                valid_length += len(line)
+        if os.path.getsize(self.file_path) > valid_length:
+            with open(self.file_path, 'r+b') as file:
+                file.truncate(valid_length)
+
+    def _save(self, new_records, store_id, chain):
+        with open(self.file_path, 'ab') as file:
+            file.write(''.join(json.dumps(record) + '\n' for record in new_records).encode(ENCODING))
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.records.extend(new_records)
+        self.store_id = store_id
+        self.chain = chain
+        temp_path = self.meta_file_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'storeId': self.store_id, 'count': len(self.records), 'chain': self.chain.to_dict()}, file)
+        os.replace(temp_path, self.meta_file_path)
+
+    def _reset(self):
+        self.records = []
+        self.store_id = None
+        self.chain = ChainState()
+        open(self.file_path, 'wb').close()
+        if exists(self.meta_file_path):
+            os.remove(self.meta_file_path)
@@ -1,28 +1,58 @@
 import requests
 import base64
-import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from cryptography.hazmat.primitives import serialization
-from common.crypto_utils import sign_data_with_key
+from common.crypto_utils import sign_data_with_key, batch_merkle_root, key_algorithm
 from requests.exceptions import HTTPError
 from common.logging import log, LogLevel
 from urllib.parse import quote
 
 ENCODING = 'utf-8'
+QUERY_PAGE_SIZE = 1000
+STATUS_WAIT = 30
+PUBLISH_BATCH_SIZE = 1000
+POOL_SIZE = 10
+RETRIES = 3
+RETRY_BACKOFF = 0.1
+
+
+class StoreChangedError(Exception):
+    pass
 
 
 class ServerInterface:
+    """
+    Talks to the server over a pooled session, so connections are kept open and reused between requests. Requests
+    that could not connect, or that were turned away with a 503 because the server was busy, are retried with an
+    exponential backoff (honouring any Retry-After header) - neither case can have reached the work queue, so
+    retrying a POST cannot publish anything twice. Requests that fail after being sent are not retried.
+    """
     post_interceptor = None
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, pool_size=POOL_SIZE, retries=RETRIES, retry_backoff=RETRY_BACKOFF):
         self.host = host
         self.port = port
+        self.pool_size = pool_size
+        self.store_id = None
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=retry_backoff,
+                      status_forcelist=[requests.codes.service_unavailable], allowed_methods=['GET', 'POST'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
 
     def register(self, client_id, private_key):
         return self._sign_and_post_and_wait(client_id, private_key, 'register', {
             'publicKey': private_key.public_key().public_bytes(
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ).decode(ENCODING)
+            ).decode(ENCODING),
+            'keyAlgorithm': key_algorithm(private_key)
         })
 
     def publish(self, client_id, private_key, message):
@@ -30,19 +60,66 @@ class ServerInterface:
             'message': message
         })
 
+    def publish_batch(self, client_id, private_key, messages):
+        """
+        Publishes the messages using one signature for each batch of up to PUBLISH_BATCH_SIZE of them, the signature
+        covers the Merkle root of the messages in the batch. Returns the final status of each batch.
+        """
+        statuses = []
+        for start in range(0, len(messages), PUBLISH_BATCH_SIZE):
+            batch = [{'message': message} for message in messages[start:start + PUBLISH_BATCH_SIZE]]
+            merkle_root = batch_merkle_root(batch)
+            signature = sign_data_with_key({'merkleRoot': merkle_root}, private_key)
+            result = self._post_json('publish/batch', {
+                'clientId': client_id,
+                'signature': base64.standard_b64encode(signature).decode(ENCODING),
+                'messages': batch
+            })
+            statuses.append(self._wait_for_status(result['requestId']))
+        return statuses
+
     def query_messages(self, key_value_pairs):
-        return self._get('query?{}'.format('&'.join(map(lambda p: '{}={}'.format(quote(p[0]), quote(p[1])), key_value_pairs))))
+        return list(self.iter_messages(key_value_pairs))
+
+    def iter_messages(self, key_value_pairs, after=None, store_id=None):
+        """
+        Yields the matching messages, fetching them a page at a time. If `store_id` is given, a StoreChangedError is
+        raised if the server's message list is not the one with that id. The id of the list the messages came from
+        is left in `self.store_id`.
+        """
+        while True:
+            page_params = list(key_value_pairs) + [('limit', str(QUERY_PAGE_SIZE))]
+            if after is not None:
+                page_params.append(('after', str(after)))
+
+            response = self._get_response('query?{}'.format('&'.join(map(lambda p: '{}={}'.format(quote(p[0]), quote(p[1])), page_params))))
+            self.store_id = response.headers.get('X-Store-Id')
+            if store_id is not None and self.store_id != store_id:
+                raise StoreChangedError("The server's message list has changed from '{}' to '{}'".format(store_id, self.store_id))
+            yield from response.json()
 
-    def _query_status(self, request_id):
-        return self._get('status/{}'.format(request_id))
+            next_cursor = response.headers.get('X-Next-Cursor')
+            if next_cursor is None:
+                return
+            after = int(next_cursor)
+
+    def get_proof(self, request_id):
+        return self._get('proof/{}'.format(quote(request_id)))
+
+    def get_server_key(self):
+        return self._get('server-key')['publicKey']
+
+    def query_status(self, request_id, wait=0):
+        return self._get('status/{}?wait={}'.format(quote(request_id), wait) if wait else 'status/{}'.format(quote(request_id)))
 
     def _sign_and_post_and_wait(self, client_id, private_key, url_path, data):
-        request_id = self._sign_and_post(client_id, private_key, url_path, data)
+        return self._wait_for_status(self._sign_and_post(client_id, private_key, url_path, data))
+
+    def _wait_for_status(self, request_id):
         while True:
-            time.sleep(1)
-            log(LogLevel.DEBUG, 'Polling server...')
-            status = self._query_status(request_id)
-            if status != 'PENDING':
+            log(LogLevel.DEBUG, 'Waiting for server...')
+            status = self.query_status(request_id, STATUS_WAIT)
+            if status['status'] != 'PENDING':
                 return status
 
     def _sign_and_post(self, client_id, private_key, url_path, data):
@@ -56,19 +133,69 @@ class ServerInterface:
         return self._post(url_path, body)
 
     def _post(self, url_path, body):
+        return self._post_json(url_path, body)['requestId']
+
+    def _post_json(self, url_path, body):
         body = self._apply_post_interceptor(body)
-        response = requests.post("http://{}:{}/api/{}".format(self.host, self.port, url_path), json=body)
+        response = self.session.post("http://{}:{}/api/{}".format(self.host, self.port, url_path), json=body)
         if response.status_code == requests.codes.accepted:
-            return response.json()['requestId']
+            return response.json()
         else:
             raise HTTPError(response.json()['error'])
 
     def _get(self, url_path):
-        response = requests.get("http://{}:{}/api/{}".format(self.host, self.port, url_path))
+        return self._get_response(url_path).json()
+
+    def _get_response(self, url_path):
+        response = self.session.get("http://{}:{}/api/{}".format(self.host, self.port, url_path))
         if response.status_code == requests.codes.ok:
-            return response.json()
+            return response
         else:
             raise HTTPError(response.json())
 
     def _apply_post_interceptor(self, json_body):
         return ServerInterface.post_interceptor(json_body) if ServerInterface.post_interceptor else json_body
+
+
+class AsyncServerInterface:
+    """
+    Runs requests from a ServerInterface on a thread pool as large as its connection pool, so that bulk tools can
+    have many publications or status checks in flight at once from asyncio code.
+    """
+    def __init__(self, server_interface):
+        self.server_interface = server_interface
+        self.executor = ThreadPoolExecutor(max_workers=server_interface.pool_size)
+
+    async def register(self, client_id, private_key):
+        return await self._run(self.server_interface.register, client_id, private_key)
+
+    async def register_many(self, client_ids, get_key, window):
+        """
+        Registers each client id, using `get_key` to find its private key, with at most `window` registrations in
+        flight at once. Returns the final status of each registration in order, or the exception it failed with.
+        """
+        semaphore = asyncio.Semaphore(window)
+
+        async def register(client_id):
+            async with semaphore:
+                return await self.register(client_id, get_key(client_id))
+
+        return await asyncio.gather(*[register(client_id) for client_id in client_ids], return_exceptions=True)
+
+    async def publish(self, client_id, private_key, message):
+        return await self._run(self.server_interface.publish, client_id, private_key, message)
+
+    async def publish_many(self, client_id, private_key, messages):
+        return await asyncio.gather(*[self.publish(client_id, private_key, message) for message in messages])
+
+    async def query_status(self, request_id, wait=0):
+        return await self._run(self.server_interface.query_status, request_id, wait)
+
+    async def query_statuses(self, request_ids, wait=0):
+        return await asyncio.gather(*[self.query_status(request_id, wait) for request_id in request_ids])
+
+    def close(self):
+        self.executor.shutdown()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
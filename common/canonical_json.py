@@ -0,0 +1,21 @@
+"""
+The canonical JSON encoding that signatures and record hashes are computed over, and that the message log is written
+in. Object keys are sorted, every non-ASCII character is escaped as \\uXXXX, items are separated by ', ' and keys
+from values by ': ', and NaN or infinite numbers are rejected. Apart from that last point this is exactly the output
+of json.dumps(value, sort_keys=True), which existing signatures were made over, so it must never change.
+
+A single encoder is shared by every call, rather than json.dumps building a new one each time it is given options.
+"""
+import json
+
+ENCODING = 'utf-8'
+
+_encoder = json.JSONEncoder(sort_keys=True, allow_nan=False, check_circular=False)
+
+
+def encode(value):
+    return _encoder.encode(value)
+
+
+def encode_bytes(value):
+    return _encoder.encode(value).encode(ENCODING)
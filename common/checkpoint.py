@@ -0,0 +1,97 @@
+"""
+Hash checkpoints over the message list. Every record in the list, including the hash records themselves, is folded
+into a running SHA-256 chain and a Merkle tree as it is added. A hash record holds the state of both after all the
+records that came before it, so anyone reading the list from the start can check each hash record in a single pass.
+"""
+import hashlib
+from common import canonical_json
+from common.crypto_utils import verify_signature
+from common.merkle import leaf_hash, root_from_audit_path, MerkleAccumulator
+
+CHECKPOINT_TYPE = 'hash'
+GENESIS_HASH = bytes(32)
+
+
+def record_leaf_hash(message, encoded=None):
+    """
+    Returns the Merkle leaf hash of a record. If the record's canonical encoding is already to hand, pass it as
+    `encoded` to avoid encoding the record again.
+    """
+    return leaf_hash(canonical_json.encode_bytes(message) if encoded is None else encoded)
+
+
+class ChainState:
+    def __init__(self, count=0, chain_hash=GENESIS_HASH, accumulator=None):
+        self.count = count
+        self.chain_hash = chain_hash
+        self.accumulator = accumulator if accumulator else MerkleAccumulator()
+
+    def add(self, message):
+        self.add_leaf(record_leaf_hash(message))
+
+    def add_leaf(self, leaf):
+        self.chain_hash = hashlib.sha256(self.chain_hash + leaf).digest()
+        self.accumulator.add(leaf)
+        self.count += 1
+
+    def summary(self):
+        return {'count': self.count, 'chainHash': self.chain_hash.hex(), 'merkleRoot': self.accumulator.root().hex()}
+
+    def copy(self):
+        return ChainState(self.count, self.chain_hash, self.accumulator.copy())
+
+    def check(self, message):
+        """
+        Raises a ValueError if the message is a hash record that does not match the records added so far.
+        """
+        if message.get('type') == CHECKPOINT_TYPE:
+            expected = self.summary()
+            data = message.get('data', {})
+            if {key: data.get(key) for key in expected} != expected:
+                raise ValueError('Hash record at position {} does not match the records before it'.format(self.count))
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'chainHash': self.chain_hash.hex(),
+            'subtreeRoots': [root.hex() for root in self.accumulator.subtree_roots]
+        }
+
+    @staticmethod
+    def from_dict(details):
+        accumulator = MerkleAccumulator(details['count'], [bytes.fromhex(root) for root in details['subtreeRoots']])
+        return ChainState(details['count'], bytes.fromhex(details['chainHash']), accumulator)
+
+
+def verify_checkpoints(messages):
+    """
+    Checks every hash record in the messages against the records before it. Returns the number of records read, the
+    number of hash records checked and the number of records covered by the last hash record, raises a ValueError at
+    the first hash record that does not match.
+    """
+    state = ChainState()
+    checkpoint_count = 0
+    covered_count = 0
+    for message in messages:
+        state.check(message)
+        if message.get('type') == CHECKPOINT_TYPE:
+            checkpoint_count += 1
+            covered_count = state.count
+        state.add(message)
+
+    return state.count, checkpoint_count, covered_count
+
+
+def verify_inclusion_proof(proof, server_public_key):
+    """
+    Checks that the record in a response from /api/proof is part of the Merkle tree whose root the server signed,
+    raising a ValueError if it is not.
+    """
+    tree_head = proof['treeHead']
+    if not verify_signature(tree_head, proof['treeHeadSignature'], server_public_key):
+        raise ValueError('Bad server signature on the tree head')
+
+    audit_path = [bytes.fromhex(node) for node in proof['proof']]
+    root = root_from_audit_path(record_leaf_hash(proof['record']), proof['index'], tree_head['size'], audit_path)
+    if root.hex() != tree_head['merkleRoot']:
+        raise ValueError("Record '{}' is not included in the signed tree".format(proof['requestId']))
@@ -1,24 +1,101 @@
-import json, base64
+import base64, hashlib, threading
+from collections import OrderedDict
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, ec, ed25519
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.backends import default_backend
+from common import canonical_json
+from common.merkle import data_leaf_hash, merkle_root, root_from_audit_path
 
 ENCODING='utf-8'
+PUBLIC_KEY_CACHE_SIZE = 10000
+
+RSA = 'rsa'
+ED25519 = 'ed25519'
+P256 = 'p256'
+KEY_ALGORITHMS = [RSA, ED25519, P256]
+
+RSA_PADDING = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+ECDSA_SHA256 = ec.ECDSA(hashes.SHA256())
+
+
+class ParsedKeyCache:
+    """
+    Bounded LRU cache of parsed public key objects, keyed by a digest of the PEM string they were parsed from, so
+    that repeated verifications of messages from the same client don't have to parse the same key every time.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, public_key_string):
+        digest = hashlib.sha256(public_key_string.encode(ENCODING)).digest()
+        with self.lock:
+            key = self.keys.get(digest)
+            if key is not None:
+                self.keys.move_to_end(digest)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        key = load_pem_public_key(public_key_string.encode(ENCODING), backend=default_backend())
+        with self.lock:
+            self.keys[digest] = key
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+                self.evictions += 1
+        return key
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.keys), 'maxSize': self.max_size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+
+public_key_cache = ParsedKeyCache(PUBLIC_KEY_CACHE_SIZE)
+
+
+def generate_private_key(algorithm=RSA):
+    """
+    Creates a new key for one of the KEY_ALGORITHMS - RSA-2048 signing with PSS and SHA-256, Ed25519, or ECDSA with
+    SHA-256 over the P-256 curve.
+    """
+    if algorithm == RSA:
+        return rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=2048)
+    if algorithm == ED25519:
+        return ed25519.Ed25519PrivateKey.generate()
+    if algorithm == P256:
+        return ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+    raise ValueError("Unknown key algorithm '{}', expected one of {}".format(algorithm, ', '.join(KEY_ALGORITHMS)))
+
+
+def key_algorithm(key):
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return RSA
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return ED25519
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) and isinstance(key.curve, ec.SECP256R1):
+        return P256
+    raise ValueError('Unsupported key type {}'.format(type(key).__name__))
 
 
 def sign_data_with_key(data, key):
-    text = __dict_to_json(data)
-    return key.sign(
-        data=text.encode(ENCODING),
-        padding=padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.MAX_LENGTH
-        ),
-        algorithm=hashes.SHA256()
-    )
+    data_bytes = canonical_json.encode_bytes(data)
+    algorithm = key_algorithm(key)
+    if algorithm == RSA:
+        return key.sign(data_bytes, RSA_PADDING, hashes.SHA256())
+    if algorithm == ED25519:
+        return key.sign(data_bytes)
+    return key.sign(data_bytes, ECDSA_SHA256)
 
 
 def verify_signature(data, signature, public_key):
@@ -28,28 +105,44 @@ def verify_signature(data, signature, public_key):
     if isinstance(signature, str):
         signature = parse_signature(signature)
 
-    text = __dict_to_json(data)
+    data_bytes = canonical_json.encode_bytes(data)
+    algorithm = key_algorithm(public_key)
     try:
-        public_key.verify(
-            signature=signature,
-            data=text.encode(ENCODING),
-            padding=padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            algorithm=hashes.SHA256()
-        )
+        if algorithm == RSA:
+            public_key.verify(signature, data_bytes, RSA_PADDING, hashes.SHA256())
+        elif algorithm == ED25519:
+            public_key.verify(signature, data_bytes)
+        else:
+            public_key.verify(signature, data_bytes, ECDSA_SHA256)
         return True
 
     except InvalidSignature:
         return False
 
+def batch_merkle_root(messages):
+    return merkle_root([data_leaf_hash(data) for data in messages]).hex()
+
+
+def verify_batch_signature(data, batch, signature, public_key):
+    """
+    Checks a message that was published as part of a batch. The batch signature covers the Merkle root of all the
+    messages in the batch, so the root is recomputed from this message and its audit path and then checked against
+    the signature.
+    """
+    try:
+        proof = [bytes.fromhex(node) for node in batch['proof']]
+        root = root_from_audit_path(data_leaf_hash(data), batch['index'], batch['size'], proof).hex()
+    except (KeyError, TypeError, ValueError):
+        return False
+
+    if root != batch['merkleRoot']:
+        return False
+    return verify_signature({'merkleRoot': root}, signature, public_key)
+
+
 def parse_public_key(public_key_string):
-    return load_pem_public_key(public_key_string.encode(ENCODING), backend=default_backend())
+    return public_key_cache.get(public_key_string)
 
 def parse_signature(signature_string):
     return base64.standard_b64decode(signature_string)
 
-
-def __dict_to_json(dict):
-    return json.dumps(dict, sort_keys=True)
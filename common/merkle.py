@@ -0,0 +1,159 @@
+"""
+Merkle tree hashing in the style of RFC 6962 - leaves and interior nodes are hashed with different prefixes, and a
+tree of n leaves is split into a left subtree holding the largest power of 2 smaller than n leaves, and a right
+subtree holding the rest.
+"""
+import hashlib
+from common import canonical_json
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+HASH_SIZE = 32
+
+
+def leaf_hash(leaf_bytes):
+    return hashlib.sha256(LEAF_PREFIX + leaf_bytes).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def data_leaf_hash(data):
+    return leaf_hash(canonical_json.encode_bytes(data))
+
+
+def merkle_root(leaf_hashes):
+    if not leaf_hashes:
+        return hashlib.sha256(b'').digest()
+    if len(leaf_hashes) == 1:
+        return leaf_hashes[0]
+    split = _split_point(len(leaf_hashes))
+    return node_hash(merkle_root(leaf_hashes[:split]), merkle_root(leaf_hashes[split:]))
+
+
+def audit_paths(leaf_hashes):
+    """
+    Returns the root of the tree, and for each leaf the list of hashes needed to recompute the root from that leaf,
+    starting with the one closest to the leaf.
+    """
+    if len(leaf_hashes) == 1:
+        return leaf_hashes[0], [[]]
+    split = _split_point(len(leaf_hashes))
+    left_root, left_paths = audit_paths(leaf_hashes[:split])
+    right_root, right_paths = audit_paths(leaf_hashes[split:])
+    return node_hash(left_root, right_root), [path + [right_root] for path in left_paths] + [path + [left_root] for path in right_paths]
+
+
+def root_from_audit_path(leaf, index, size, path):
+    if not 0 <= index < size:
+        raise ValueError('Leaf index {} is outside a tree of size {}'.format(index, size))
+    return _root_from_path(leaf, index, size, list(path))
+
+
+def _root_from_path(node, index, size, path):
+    if size == 1:
+        if path:
+            raise ValueError('Audit path is too long')
+        return node
+    if not path:
+        raise ValueError('Audit path is too short')
+
+    split = _split_point(size)
+    sibling = path.pop()
+    if index < split:
+        return node_hash(_root_from_path(node, index, split, path), sibling)
+    return node_hash(sibling, _root_from_path(node, index - split, size - split, path))
+
+
+def _split_point(size):
+    split = 1
+    while split * 2 < size:
+        split *= 2
+    return split
+
+
+class MerkleAccumulator:
+    """
+    Keeps the root of a growing Merkle tree up to date without holding on to its leaves. Only the roots of the perfect
+    subtrees that make up the tree are kept (largest first, at most one of each size), so adding a leaf costs
+    O(log n) and the root of the whole tree can be recomputed from them at any point.
+    """
+    def __init__(self, size=0, subtree_roots=()):
+        self.size = size
+        self.subtree_roots = list(subtree_roots)
+
+    def add(self, leaf):
+        self.subtree_roots.append(leaf)
+        size = self.size
+        while size & 1:
+            right = self.subtree_roots.pop()
+            left = self.subtree_roots.pop()
+            self.subtree_roots.append(node_hash(left, right))
+            size >>= 1
+        self.size += 1
+
+    def root(self):
+        if not self.subtree_roots:
+            return merkle_root([])
+        root = self.subtree_roots[-1]
+        for left in reversed(self.subtree_roots[:-1]):
+            root = node_hash(left, root)
+        return root
+
+    def copy(self):
+        return MerkleAccumulator(self.size, self.subtree_roots)
+
+
+class MerkleTree:
+    """
+    Keeps every level of a growing Merkle tree - the leaves, then the roots of each complete subtree of 2 leaves, of 4
+    leaves and so on - so that the root of any leading part of the tree, and the audit path for any leaf within that
+    part, can be found by combining O(log n) stored nodes rather than rehashing the leaves. Each level is held as one
+    bytearray of fixed-size hashes, which keeps large trees compact and quick to save and reload.
+    """
+    def __init__(self):
+        self.levels = [bytearray()]
+
+    def __len__(self):
+        return len(self.levels[0]) // HASH_SIZE
+
+    def add(self, leaf):
+        self.levels[0] += leaf
+        level = 0
+        while len(self.levels[level]) // HASH_SIZE % 2 == 0:
+            if level + 1 == len(self.levels):
+                self.levels.append(bytearray())
+            nodes = self.levels[level]
+            self.levels[level + 1] += node_hash(bytes(nodes[-2 * HASH_SIZE:-HASH_SIZE]), bytes(nodes[-HASH_SIZE:]))
+            level += 1
+
+    def truncate(self, size):
+        for level, nodes in enumerate(self.levels):
+            del nodes[(size >> level) * HASH_SIZE:]
+
+    def root(self, size=None):
+        size = len(self) if size is None else size
+        return self._subtree_root(0, size) if size else merkle_root([])
+
+    def audit_path(self, index, size=None):
+        size = len(self) if size is None else size
+        if not 0 <= index < size:
+            raise ValueError('Leaf index {} is outside a tree of size {}'.format(index, size))
+        return self._audit_path(index, 0, size)
+
+    def _audit_path(self, index, start, size):
+        if size == 1:
+            return []
+        split = _split_point(size)
+        if index < start + split:
+            return self._audit_path(index, start, split) + [self._subtree_root(start + split, size - split)]
+        return self._audit_path(index, start + split, size - split) + [self._subtree_root(start, split)]
+
+    def _subtree_root(self, start, size):
+        if size & (size - 1) == 0:
+            level = size.bit_length() - 1
+            position = (start >> level) * HASH_SIZE
+            return bytes(self.levels[level][position:position + HASH_SIZE])
+        split = _split_point(size)
+        return node_hash(self._subtree_root(start, split), self._subtree_root(start + split, size - split))
@@ -1 +1 @@
-python -m unittest test.integration_test
\ No newline at end of file
+python -m unittest discover -s test -p '*_test.py' -t .
@@ -0,0 +1,55 @@
+import time
+from common.checkpoint import ChainState, CHECKPOINT_TYPE, record_leaf_hash
+from common.merkle import MerkleTree
+
+
+class Checkpointer:
+    """
+    Follows every record added to the message store, keeping the hash chain and Merkle tree up to date one record at
+    a time, and decides when the next hash record is due - once `interval_messages` records have been added since the
+    last one, or once `interval_seconds` have passed if any records have been added at all.
+
+    The full Merkle tree is kept as well, so that inclusion proofs can be given for any record.
+    """
+    def __init__(self, interval_messages=1000, interval_seconds=60):
+        self.interval_messages = interval_messages
+        self.interval_seconds = interval_seconds
+        self.state = ChainState()
+        self.tree = MerkleTree()
+        self.since_checkpoint = 0
+        self.last_checkpoint_time = time.monotonic()
+
+    def record(self, message, encoded=None):
+        leaf = record_leaf_hash(message, encoded)
+        self.state.add_leaf(leaf)
+        self.tree.add(leaf)
+        if message['type'] == CHECKPOINT_TYPE:
+            self.since_checkpoint = 0
+            self.last_checkpoint_time = time.monotonic()
+        else:
+            self.since_checkpoint += 1
+
+    def is_due(self):
+        if not self.since_checkpoint:
+            return False
+        return self.since_checkpoint >= self.interval_messages or time.monotonic() - self.last_checkpoint_time >= self.interval_seconds
+
+    def build_checkpoint(self):
+        return {'type': CHECKPOINT_TYPE, 'timestamp': int(time.time()), 'data': self.state.summary()}
+
+    def save_state(self):
+        return self.state.copy(), self.since_checkpoint, self.last_checkpoint_time
+
+    def restore_state(self, saved_state):
+        state, self.since_checkpoint, self.last_checkpoint_time = saved_state
+        self.state = state.copy()
+        self.tree.truncate(state.count)
+
+    def get_snapshot_state(self):
+        return {'state': self.state, 'tree': self.tree, 'sinceCheckpoint': self.since_checkpoint}
+
+    def restore_snapshot_state(self, snapshot_state):
+        self.state = snapshot_state['state']
+        self.tree = snapshot_state['tree']
+        self.since_checkpoint = snapshot_state['sinceCheckpoint']
+        self.last_checkpoint_time = time.monotonic()
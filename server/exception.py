@@ -2,4 +2,10 @@ class InvalidRequest(Exception):
     pass
 
 class InvalidSignatureError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class QueueFullError(Exception):
+    pass
+
+class DuplicateRegistrationError(Exception):
+    pass
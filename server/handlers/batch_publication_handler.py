@@ -0,0 +1,20 @@
+from server.handlers.base_handler import BaseHandler
+
+
+class BatchPublicationHandler(BaseHandler):
+    def __init__(self, message_store):
+        super().__init__(message_store)
+
+    def handles(self, details):
+        return details['type'] == 'publication_batch'
+
+    def process(self, details):
+        for publication in details['publications']:
+            self.message_store.add({
+                'type': 'publication',
+                'requestId': publication['requestId'],
+                'clientId': details['clientId'],
+                'signature': details['signature'],
+                'data': publication['data'],
+                'batch': publication['batch']
+            })
@@ -1,4 +1,6 @@
 from server.handlers.base_handler import BaseHandler
+from server.exception import DuplicateRegistrationError
+from common.crypto_utils import parse_public_key, key_algorithm, RSA
 
 
 class RegistrationHandler(BaseHandler):
@@ -9,7 +11,10 @@ class RegistrationHandler(BaseHandler):
         return details['type'] == 'registration'
 
     def process(self, details):
-        print(details)
-        if list(filter(lambda msg: msg['type'] == 'registration' and msg['clientId'] == details['clientId'], self.message_store.messages)):
-            raise ValueError("The id '{}' has already been registered".format(details['clientId']))
+        if self.message_store.get_registration(details['clientId']):
+            raise DuplicateRegistrationError("The id '{}' has already been registered".format(details['clientId']))
+        # registrations from before keyAlgorithm was recorded are all RSA
+        algorithm = details['data'].get('keyAlgorithm', RSA)
+        if key_algorithm(parse_public_key(details['publicKey'])) != algorithm:
+            raise ValueError("The public key for '{}' is not a {} key".format(details['clientId'], algorithm))
         self.message_store.add(details)
@@ -1,8 +1,14 @@
-from .web_server import WebServer
-from .work_queue import WorkQueue
-from .request_processor import RequestProcessor
+from .web_server import WebServer, THREADED
+from .work_queue import WorkQueue, request_ids_for
+from .request_processor import RequestProcessor, THREAD_POOL
+from .message_store import MessageStore
+from .checkpoint import Checkpointer
+from .server_key import ServerKey
+from .storage.state_snapshot_storage import StateSnapshotStorage
+from .storage.work_journal import WorkJournal
 from common.logging import LogLevel
 import logging
+import os
 import threading
 import socket
 import time
@@ -10,19 +16,37 @@ from signal import signal, SIGINT
 
 HOST = '127.0.0.1'
 PORT = 5000
+INDEXED_PATHS = ['data.message']
+VERIFICATION_WORKERS = os.cpu_count() or 1
+VERIFICATION_POOL = THREAD_POOL
+BATCH_SIZE = 100
+BATCH_LINGER = 0.005
+QUEUE_CAPACITY = 100000
+QUEUE_HIGH_WATER_MARK = 90000
+RETRY_AFTER = 1
+STATUS_TTL = 3600
+SERVER_MODE = THREADED
+SERVER_THREADS = 32
+CHECKPOINT_MESSAGES = 1000
+CHECKPOINT_SECONDS = 60
+STATE_SNAPSHOT_EVERY = 100000
+WORK_JOURNAL = True
 
 class ServerManager:
     def __init__(self):
         self.server = None
 
     def start(self):
-        work_queue = WorkQueue()
-        processor = RequestProcessor(work_queue)
-        self.server = WebServer(HOST, PORT, work_queue)
+        message_store = MessageStore(indexed_paths=INDEXED_PATHS, checkpointer=Checkpointer(CHECKPOINT_MESSAGES, CHECKPOINT_SECONDS),
+                                     state_snapshots=StateSnapshotStorage(), state_snapshot_every=STATE_SNAPSHOT_EVERY)
+        work_queue = WorkQueue(QUEUE_CAPACITY, QUEUE_HIGH_WATER_MARK, STATUS_TTL, WorkJournal() if WORK_JOURNAL else None)
+        processor = RequestProcessor(work_queue, message_store, VERIFICATION_WORKERS, VERIFICATION_POOL, BATCH_SIZE, BATCH_LINGER)
+        self.server = WebServer(HOST, PORT, work_queue, message_store, RETRY_AFTER, SERVER_MODE, SERVER_THREADS, ServerKey())
 
         LogLevel.currentLevel = LogLevel.DEBUG
 
         processor.start()
+        work_queue.recover(lambda item: is_processed(message_store, item))
         threading.Thread(target=self.server.start).start()
         self._wait_for_port_state(True)
 
@@ -42,6 +66,10 @@ class ServerManager:
         sock.close()
         return is_open
 
+def is_processed(message_store, item):
+    snapshot = message_store.snapshot()
+    return any(snapshot.get_offsets('requestId', request_id) for request_id in request_ids_for(item))
+
 server_manager = ServerManager()
 
 def handle_ctrl_c(sig, frame):
@@ -1,23 +1,322 @@
-import json, os.path
+import json, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import islice
+from common import canonical_json
+from common.logging import log, LogLevel
+from server.storage.log_storage import LogStorage
 
+DEFAULT_INDEXED_PATHS = ['clientId', 'type', 'requestId']
+STATE_FORMAT_VERSION = 1
+MISSING = object()
 
-class MessageStore:
-    file_path = 'store.json'
 
-    def __init__(self):
-        if os.path.exists(MessageStore.file_path):
-            with open(MessageStore.file_path, 'r') as file:
-                self.messages = json.load(file)
+def get_path_value(message, key_path):
+    value = message
+    for key_part in key_path:
+        if isinstance(value, dict) and key_part in value:
+            value = value[key_part]
         else:
-            self.messages = []
+            return MISSING
+    return value
+
+
+class MessageStore:
+    """
+    Gives access to all published messages along with some indexes over them. Messages are read from storage by
+    offset when they are needed, only the indexes and the registrations are held in memory. A single MessageStore
+    instance is shared between the request processor, which adds messages, and the web server, which reads them.
+    Writers are serialised by a lock, readers never take the lock - instead they work from a snapshot, which sees only
+    the messages that had been fully added when it was taken.
+
+    Messages added inside a `batch()` block are written to storage together when the block exits, and only become
+    visible to snapshots at that point. If the block fails, none of the messages added inside it are kept.
+
+    Every message is indexed by clientId, type and requestId, further dotted paths (eg 'data.message') can be
+    indexed by passing them in `indexed_paths`.
+
+    Each message is encoded as canonical JSON once, when it is added. The same bytes are written to storage, hashed by
+    the checkpointer, and returned by `get_raw` so that query results can be sent without encoding them again.
+
+    If a `checkpointer` is supplied, every message is passed to it as it is added, and hash records are appended to
+    the store whenever it says one is due.
+
+    If `state_snapshots` is supplied, the indexes, registrations and checkpointer state are saved to it every
+    `state_snapshot_every` messages, and when the store is opened it starts from the latest saved state, reading only
+    the messages added after it rather than the whole log.
+    """
+    def __init__(self, storage=None, read_only=False, indexed_paths=(), checkpointer=None, state_snapshots=None, state_snapshot_every=100000):
+        self.storage = storage if storage else LogStorage(read_only=read_only)
+        self.storage.open()
+        self.lock = threading.RLock()
+        self.checkpointer = checkpointer
+        self.batch_messages = None
+        self.batch_encoded = None
+        self.length = 0
+        self.registration_offsets = {}
+        self.registrations = {}
+        self.publication_offsets = {}
+        self.field_indexes = {path: {} for path in DEFAULT_INDEXED_PATHS + [p for p in indexed_paths if p not in DEFAULT_INDEXED_PATHS]}
+        self.field_index_key_paths = {path: path.split('.') for path in self.field_indexes}
+        self.state_snapshots = state_snapshots
+        self.state_snapshot_every = state_snapshot_every
+        self.state_snapshot_position = 0
+        start = self._restore_state() if state_snapshots else 0
+        for encoded in self.storage.load_raw(start):
+            self._append(json.loads(encoded), encoded)
+        self.version = self.length
 
     def add(self, message):
-        self.messages.append(message)
-        self._save()
+        with self.lock:
+            self._store(message)
+            self._checkpoint_if_due()
+
+    def checkpoint_if_due(self):
+        with self.lock:
+            self._checkpoint_if_due()
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_messages = []
+            self.batch_encoded = []
+            saved_checkpointer_state = self.checkpointer.save_state() if self.checkpointer else None
+            try:
+                yield
+                if self.batch_messages:
+                    self.storage.append(self.batch_messages, self.batch_encoded)
+                self.version = self.length
+
+            except BaseException:
+                self._truncate(self.version)
+                if self.checkpointer:
+                    self.checkpointer.restore_state(saved_checkpointer_state)
+                raise
+
+            finally:
+                self.batch_messages = None
+                self.batch_encoded = None
+
+    def sync(self):
+        with self.lock:
+            self.storage.sync()
+
+    def save_state_if_due(self):
+        if self.state_snapshots and self.version - self.state_snapshot_position >= self.state_snapshot_every:
+            self.save_state()
+
+    def save_state(self):
+        with self.lock:
+            if self.batch_messages is not None:
+                raise ValueError('Unable to save state while a batch is in progress')
+            # the log must hold every message the saved state refers to before the state is written
+            self.storage.sync()
+            self.state_snapshots.save(self.version, {
+                'format': STATE_FORMAT_VERSION,
+                'indexedPaths': sorted(self.field_indexes),
+                'length': self.length,
+                'registrationOffsets': self.registration_offsets,
+                'registrations': self.registrations,
+                'publicationOffsets': self.publication_offsets,
+                'fieldIndexes': self.field_indexes,
+                'checkpointer': self.checkpointer.get_snapshot_state() if self.checkpointer else None
+            })
+            self.state_snapshot_position = self.version
+
+    def snapshot(self):
+        return MessageStoreSnapshot(self, self.version)
+
+    @property
+    def store_id(self):
+        return self.storage.store_id
+
+    def get(self, offset):
+        committed_count = self.storage.count
+        if offset < committed_count:
+            return self.storage.read(offset)
+        return self.batch_messages[offset - committed_count]
+
+    def get_raw(self, offset):
+        committed_count = self.storage.count
+        if offset < committed_count:
+            return self.storage.read_raw(offset)
+        return self.batch_encoded[offset - committed_count]
+
+    def get_all(self):
+        return (self.get(offset) for offset in range(self.length))
+
+    def get_registration(self, client_id):
+        return self.registrations.get(client_id)
+
+    def get_publications(self, client_id):
+        return [self.get(offset) for offset in self.publication_offsets.get(client_id, [])]
+
+    def get_offsets_for_type(self, message_type):
+        return self.get_offsets('type', message_type)
+
+    def has_index(self, path):
+        return path in self.field_indexes
+
+    def get_offsets(self, path, value):
+        return self.field_indexes[path].get(value, [])
+
+    def close(self):
+        with self.lock:
+            self.storage.close()
+
+    def _restore_state(self):
+        snapshot = self.state_snapshots.load_latest(self.storage.count)
+        if snapshot is None:
+            return 0
+
+        position, state = snapshot
+        if state['format'] != STATE_FORMAT_VERSION or state['indexedPaths'] != sorted(self.field_indexes) or \
+                (state['checkpointer'] is None) != (self.checkpointer is None):
+            log(LogLevel.INFO, 'Ignoring state snapshot at position {} as it was saved with different settings'.format(position))
+            return 0
+
+        self.length = state['length']
+        self.registration_offsets = state['registrationOffsets']
+        self.registrations = state['registrations']
+        self.publication_offsets = state['publicationOffsets']
+        self.field_indexes = state['fieldIndexes']
+        if self.checkpointer:
+            self.checkpointer.restore_snapshot_state(state['checkpointer'])
+        self.state_snapshot_position = position
+        log(LogLevel.INFO, 'Restored state snapshot at position {}'.format(position))
+        return position
+
+    def _store(self, message):
+        encoded = canonical_json.encode_bytes(message)
+        if self.batch_messages is None:
+            self.storage.append([message], [encoded])
+            self._append(message, encoded)
+            self.version = self.length
+        else:
+            self._append(message, encoded)
+            self.batch_messages.append(message)
+            self.batch_encoded.append(encoded)
+
+    def _checkpoint_if_due(self):
+        if self.checkpointer and self.checkpointer.is_due():
+            self._store(self.checkpointer.build_checkpoint())
+
+    def _truncate(self, length):
+        while self.length > length:
+            offset = self.length - 1
+            message = self.get(offset)
+            self.length -= 1
+
+            for path, index in self.field_indexes.items():
+                value = get_path_value(message, self.field_index_key_paths[path])
+                if isinstance(value, str):
+                    self._remove_last_offset(index, value)
+
+            message_type = message['type']
+            if message_type == 'registration' and self.registration_offsets.get(message['clientId']) == offset:
+                del self.registration_offsets[message['clientId']]
+                del self.registrations[message['clientId']]
+            elif message_type == 'publication':
+                self._remove_last_offset(self.publication_offsets, message['clientId'])
+
+    def _remove_last_offset(self, offsets_by_key, key):
+        offsets = offsets_by_key[key]
+        offsets.pop()
+        if not offsets:
+            del offsets_by_key[key]
+
+    def _append(self, message, encoded=None):
+        offset = self.length
+        self.length += 1
+        if self.checkpointer:
+            self.checkpointer.record(message, encoded)
+
+        for path, index in self.field_indexes.items():
+            value = get_path_value(message, self.field_index_key_paths[path])
+            # query values always arrive as strings, so other values could never be matched by an index lookup
+            if isinstance(value, str):
+                index.setdefault(value, []).append(offset)
+
+        message_type = message['type']
+        if message_type == 'registration':
+            if message['clientId'] not in self.registration_offsets:
+                self.registration_offsets[message['clientId']] = offset
+                self.registrations[message['clientId']] = message
+        elif message_type == 'publication':
+            self.publication_offsets.setdefault(message['clientId'], []).append(offset)
+
+
+class MessageStoreSnapshot:
+    """
+    A read-only view of a MessageStore at a particular version. Messages added after the snapshot was taken are
+    not visible through it.
+    """
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+
+    def __len__(self):
+        return self.version
+
+    def get_registration(self, client_id):
+        offset = self.store.registration_offsets.get(client_id)
+        return None if offset is None or offset >= self.version else self.store.registrations.get(client_id)
+
+    def get(self, offset):
+        if not 0 <= offset < self.version:
+            raise IndexError('Offset {} is not in snapshot of size {}'.format(offset, self.version))
+        return self.store.get(offset)
+
+    def get_raw(self, offset):
+        if not 0 <= offset < self.version:
+            raise IndexError('Offset {} is not in snapshot of size {}'.format(offset, self.version))
+        return self.store.get_raw(offset)
 
     def get_all(self):
-        return self.messages
+        return (self.store.get(offset) for offset in range(self.version))
+
+    def get_offsets_for_type(self, message_type):
+        return self._visible(self.store.get_offsets_for_type(message_type))
+
+    def get_inclusion_proof(self, offset):
+        """
+        Returns the audit path for the record at `offset`, and the root of the Merkle tree over all the records in the
+        snapshot. Only available if the store has a checkpointer.
+        """
+        tree = self.store.checkpointer.tree
+        return tree.audit_path(offset, self.version), tree.root(self.version)
+
+    def has_index(self, path):
+        return self.store.has_index(path)
+
+    def get_offsets(self, path, value):
+        return self._visible(self.store.get_offsets(path, value))
+
+    def _visible(self, offsets):
+        return OffsetList(offsets, bisect_left(offsets, self.version))
+
+
+class OffsetList:
+    """
+    The leading part of one of the store's offset lists that is visible to a snapshot. The store keeps appending to
+    the underlying list, so this avoids having to copy it.
+    """
+    __slots__ = ('offsets', 'length')
+
+    def __init__(self, offsets, length):
+        self.offsets = offsets
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.offsets[i]
+
+    def __iter__(self):
+        return islice(self.offsets, self.length)
 
-    def _save(self):
-        with open(MessageStore.file_path, 'w') as file:
-            json.dump(self.messages, file, indent=4)
+    def __eq__(self, other):
+        return list(self) == list(other)
@@ -0,0 +1,95 @@
+from bisect import bisect_left
+from heapq import merge
+from server.message_store import get_path_value
+
+
+class QueryEngine:
+    """
+    Finds the messages matching a list of (dotted path, value) criteria. Criteria on indexed paths are answered from
+    the store's posting lists, which are intersected starting from the shortest one. Only the candidates that remain
+    are fetched and checked against the criteria on unindexed paths. A query with no indexed criteria falls back to
+    scanning every message. If the same path appears more than once, a message matches if it has any of the values.
+    """
+    def __init__(self, message_store):
+        self.message_store = message_store
+
+    def plan(self, criteria, snapshot=None):
+        snapshot = snapshot or self.message_store.snapshot()
+        index_lookups = []
+        scan_criteria = []
+        values_by_path = {}
+        for path, value in criteria:
+            values_by_path.setdefault(path, []).append(value)
+
+        for path, values in values_by_path.items():
+            if snapshot.has_index(path):
+                index_lookups.append((path, values, self._get_offsets(snapshot, path, values)))
+            else:
+                scan_criteria.append((path, values))
+
+        index_lookups.sort(key=lambda lookup: len(lookup[2]))
+        return QueryPlan(snapshot, index_lookups, scan_criteria)
+
+    def query(self, criteria, after=None):
+        return self.plan(criteria).execute(after)
+
+    def _get_offsets(self, snapshot, path, values):
+        if len(values) == 1:
+            return snapshot.get_offsets(path, values[0])
+        # each message has one value per path, so the offset lists for different values never overlap
+        return list(merge(*(snapshot.get_offsets(path, value) for value in set(values))))
+
+
+class QueryPlan:
+    def __init__(self, snapshot, index_lookups, scan_criteria):
+        self.snapshot = snapshot
+        self.index_lookups = index_lookups
+        self.scan_criteria = [(path, path.split('.'), values) for path, values in scan_criteria]
+        self.rows_examined = 0
+
+    def describe(self):
+        parts = []
+        if self.index_lookups:
+            parts.append('index:' + ','.join('{}({})'.format(path, len(offsets)) for path, values, offsets in self.index_lookups))
+        if self.scan_criteria:
+            parts.append('scan:' + ','.join(path for path, key_path, values in self.scan_criteria))
+        if not self.index_lookups:
+            parts.append('full-scan({})'.format(len(self.snapshot)))
+        return ';'.join(parts)
+
+    def candidate_offsets(self, after=None):
+        start = 0 if after is None else after + 1
+        if not self.index_lookups:
+            return range(start, len(self.snapshot))
+
+        shortest, others = self.index_lookups[0][2], [offsets for path, values, offsets in self.index_lookups[1:]]
+        remaining = (shortest[i] for i in range(bisect_left(shortest, start, 0, len(shortest)), len(shortest)))
+        return (offset for offset in remaining if all(self._contains(offsets, offset) for offsets in others))
+
+    def matches(self, after=None):
+        """
+        Yields (offset, message) for each matching message, in store order. If `after` is given only messages with
+        a greater offset are returned, so the offset of the last message in one page of results can be used as the
+        cursor for the next page.
+        """
+        for offset in self.candidate_offsets(after):
+            message = self.snapshot.get(offset)
+            self.rows_examined += 1
+            if all(get_path_value(message, key_path) in values for path, key_path, values in self.scan_criteria):
+                yield offset, message
+
+    def matching_offsets(self, after=None):
+        """
+        Yields the offset of each matching message, in store order. Messages are only read if they have to be
+        checked against criteria on unindexed paths.
+        """
+        if not self.scan_criteria:
+            return iter(self.candidate_offsets(after))
+        return (offset for offset, message in self.matches(after))
+
+    def execute(self, after=None):
+        return (message for offset, message in self.matches(after))
+
+    def _contains(self, offsets, offset):
+        i = bisect_left(offsets, offset, 0, len(offsets))
+        return i < len(offsets) and offsets[i] == offset
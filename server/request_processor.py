@@ -1,38 +1,114 @@
-import threading
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from queue import Queue, Empty
 from common.logging import log, LogLevel
 from server.exception import InvalidSignatureError
-from server.message_store import MessageStore
 from server.handlers.registration_handler import RegistrationHandler
 from server.handlers.publication_handler import PublicationHandler
+from server.handlers.batch_publication_handler import BatchPublicationHandler
 from common.crypto_utils import verify_signature
 
+THREAD_POOL = 'thread'
+PROCESS_POOL = 'process'
+
 
 class RequestProcessor:
-    def __init__(self, work_queue):
+    """
+    Processes work items in two stages. The dispatcher thread takes items from the work queue and submits their
+    signatures to a pool of verification workers, the writer thread then takes the verification results in the
+    order the items were dispatched and passes each item to the handlers. Only the writer updates the message store,
+    so publication order and duplicate-registration checks are the same as if items were processed one at a time.
+
+    A batch of publications is a single item whose signature covers the Merkle root of its messages, so the batch
+    needs only one verification however many messages it holds.
+
+    A publication from a client whose registration has not yet reached the store when it is dispatched is verified
+    by the writer instead, once all the items ahead of it have been applied.
+
+    Items are taken from the work queue in batches of up to `batch_size`, waiting at most `batch_linger` seconds for
+    a batch to fill up. The messages accepted from each batch are committed to the store with a single write.
+
+    The store is synced whenever the writer is idle, and at least every `sync_interval` seconds while it is busy, after
+    which the work queue's journal is allowed to drop the items that have been processed.
+    """
+    def __init__(self, work_queue, message_store, verification_workers=1, verification_pool=THREAD_POOL, batch_size=1, batch_linger=0,
+                 sync_interval=1.0):
         self.work_queue = work_queue
-        self.message_store = MessageStore()
-        self.handlers = [RegistrationHandler(self.message_store), PublicationHandler(self.message_store)]
+        self.message_store = message_store
+        self.handlers = [RegistrationHandler(self.message_store), PublicationHandler(self.message_store),
+                         BatchPublicationHandler(self.message_store)]
+        if verification_pool == PROCESS_POOL:
+            self.executor = ProcessPoolExecutor(max_workers=verification_workers)
+        elif verification_pool == THREAD_POOL:
+            self.executor = ThreadPoolExecutor(max_workers=verification_workers)
+        else:
+            raise ValueError("Unknown verification pool type '{}'".format(verification_pool))
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
+        self.sync_interval = sync_interval
+        self.dispatched = Queue(maxsize=max(2, verification_workers * 2))
+        self.last_sync = time.monotonic()
 
     def start(self):
+        threading.Thread(target=self._dispatch, daemon=True).start()
         threading.Thread(target=self._work, daemon=True).start()
 
-    def _verify_signature(self, item):
-        public_key = item.get('publicKey') if 'publicKey' in item else self._get_public_key_for_client_id(item['clientId'])
-        if not verify_signature(item['data'], item['signature'], public_key):
+    def _dispatch(self):
+        while True:
+            items = self.work_queue.get_batch(self.batch_size, self.batch_linger)
+            snapshot = self.message_store.snapshot()
+            self.dispatched.put([(item, self._submit_verification(item, snapshot)) for item in items])
+
+    def _submit_verification(self, item, snapshot):
+        if 'publicKey' in item:
+            public_key = item['publicKey']
+        else:
+            registration = snapshot.get_registration(item['clientId'])
+            public_key = registration['data']['publicKey'] if registration else None
+
+        if public_key is None:
+            return None
+        return self.executor.submit(verify_signature, item['data'], item['signature'], public_key)
+
+    def _verify_signature(self, item, verification):
+        if verification:
+            signature_ok = verification.result()
+        else:
+            public_key = item['publicKey'] if 'publicKey' in item else self._get_public_key_for_client_id(item['clientId'])
+            signature_ok = verify_signature(item['data'], item['signature'], public_key)
+
+        if not signature_ok:
             raise ValueError("Bad message signature for client_id '{}'".format(item['clientId']))
         log(LogLevel.DEBUG, 'Signature for {} ok'.format(item['clientId']))
 
     def _work(self):
         while True:
-            self.work_queue.process_next(self._process_item)
+            try:
+                batch = self.dispatched.get(timeout=self.sync_interval)
+            except Empty:
+                self.message_store.checkpoint_if_due()
+                self._sync()
+                continue
+
+            verifications = {item['requestId']: verification for item, verification in batch}
+            self.work_queue.process_batch([item for item, verification in batch],
+                lambda item: self._process_item(item, verifications[item['requestId']]), self.message_store.batch)
+            self.message_store.save_state_if_due()
+            if time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self.message_store.sync()
+        self.work_queue.release_processed()
+        self.last_sync = time.monotonic()
 
-    def _process_item(self, item):
+    def _process_item(self, item, verification):
         log(LogLevel.INFO, 'Processing item {}'.format(item['requestId']))
-        self._verify_signature(item)
+        self._verify_signature(item, verification)
         [handler.process(item) for handler in self.handlers if handler.handles(item)]
 
     def _get_public_key_for_client_id(self, client_id):
-        registrations_for_client = [item for item in self.message_store.messages if item['clientId'] == client_id and item['type'] == 'registration']
-        if registrations_for_client:
-            return registrations_for_client[0]['data']['publicKey']
+        registration = self.message_store.get_registration(client_id)
+        if registration:
+            return registration['data']['publicKey']
         raise ValueError('No public key found for client_id "{}"'.format(client_id))
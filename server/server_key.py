@@ -0,0 +1,51 @@
+import os, base64, threading
+from os.path import isfile
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+from common.crypto_utils import sign_data_with_key
+
+ENCODING = 'utf-8'
+
+
+class ServerKey:
+    """
+    The key the server signs its Merkle tree heads with. It is generated the first time it is needed and kept in
+    `file_path`, so that clients can go on using the same public key after the server restarts.
+    """
+    file_path = 'server_key.pem'
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path if file_path else ServerKey.file_path
+        self.private_key = None
+        self.lock = threading.Lock()
+
+    def public_key_pem(self):
+        return self._get_private_key().public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode(ENCODING)
+
+    def sign(self, data):
+        return base64.standard_b64encode(sign_data_with_key(data, self._get_private_key())).decode(ENCODING)
+
+    def _get_private_key(self):
+        with self.lock:
+            if self.private_key is None:
+                self.private_key = self._load() if isfile(self.file_path) else self._generate()
+            return self.private_key
+
+    def _load(self):
+        with open(self.file_path, 'rb') as key_file:
+            return serialization.load_pem_private_key(key_file.read(), password=None, backend=default_backend())
+
+    def _generate(self):
+        key = rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        with os.fdopen(os.open(self.file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as key_file:
+            key_file.write(pem)
+        return key
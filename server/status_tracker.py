@@ -0,0 +1,137 @@
+import threading, time, uuid
+from collections import deque
+from enum import Enum
+
+PENDING_CODE = 202
+SUCCESS_CODE = 200
+REJECTED_CODE = 400
+DUPLICATE_CODE = 409
+ERROR_CODE = 500
+
+
+class RequestStatus(Enum):
+    UNKNOWN = 0
+    PENDING = 1
+    SUCCESS = 2
+    FAILURE = 3
+
+
+def status_for_code(code):
+    if code is None:
+        return RequestStatus.UNKNOWN
+    if code == PENDING_CODE:
+        return RequestStatus.PENDING
+    if code == SUCCESS_CODE:
+        return RequestStatus.SUCCESS
+    return RequestStatus.FAILURE
+
+
+class StatusEntry:
+    __slots__ = ('code', 'description', 'completed_at')
+
+    def __init__(self, code, description=None, completed_at=None):
+        self.code = code
+        self.description = description
+        self.completed_at = completed_at
+
+
+class StatusTracker:
+    """
+    Records the status of each request that has been accepted by the server, using the same codes as the /status
+    endpoint (202 while pending, 200 once published, 400/409/500 if it failed). Requests are keyed by the 16-byte
+    form of their UUID, and only failures keep a description, so each entry is small.
+
+    Completed entries are discarded `ttl` seconds after they complete. Requests that succeeded can still be found in
+    the message store after that, failed requests are not stored anywhere so their status becomes unknown.
+
+    Callers can wait for pending requests to complete, each waiting caller is given an event which is registered
+    against the requests it is waiting for and set as soon as one of them completes.
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.entries = {}
+        self.completion_order = deque()
+        self.waiters = {}
+        self.lock = threading.Lock()
+
+    def set_pending(self, request_id):
+        with self.lock:
+            self.entries[self._key(request_id)] = StatusEntry(PENDING_CODE)
+
+    def complete(self, request_id, code, description=None):
+        key = self._key(request_id)
+        now = time.monotonic()
+        with self.lock:
+            self.entries[key] = StatusEntry(code, description, now)
+            self.completion_order.append((now, key))
+            self._evict_expired(now)
+            waiters = self.waiters.pop(key, ())
+        for event in waiters:
+            event.set()
+
+    def remove(self, request_id):
+        key = self._key(request_id)
+        with self.lock:
+            self.entries.pop(key, None)
+            waiters = self.waiters.pop(key, ())
+        for event in waiters:
+            event.set()
+
+    def wait(self, request_id, timeout):
+        """
+        Returns the status of the request once it is no longer pending, or after `timeout` seconds if that happens
+        first.
+        """
+        self.wait_any([request_id], timeout)
+        return self.get(request_id)
+
+    def wait_any(self, request_ids, timeout):
+        """
+        Waits until at least one of the requests is no longer pending, or for `timeout` seconds if that happens
+        first. Returns True if any of the requests was already complete or completed while waiting.
+        """
+        event = threading.Event()
+        with self.lock:
+            pending_keys = [key for key in map(self._key, request_ids) if self._is_pending(key)]
+            if len(pending_keys) < len(request_ids):
+                return True
+            for key in pending_keys:
+                self.waiters.setdefault(key, []).append(event)
+
+        completed = event.wait(timeout)
+        with self.lock:
+            for key in pending_keys:
+                self._remove_waiter(key, event)
+        return completed
+
+    def get(self, request_id):
+        with self.lock:
+            return self.entries.get(self._key(request_id))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _is_pending(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry.code == PENDING_CODE
+
+    def _remove_waiter(self, key, event):
+        waiters = self.waiters.get(key)
+        if waiters and event in waiters:
+            waiters.remove(event)
+            if not waiters:
+                del self.waiters[key]
+
+    def _evict_expired(self, now):
+        expiry = now - self.ttl
+        while self.completion_order and self.completion_order[0][0] <= expiry:
+            completed_at, key = self.completion_order.popleft()
+            entry = self.entries.get(key)
+            if entry is not None and entry.completed_at == completed_at:
+                del self.entries[key]
+
+    def _key(self, request_id):
+        try:
+            return uuid.UUID(request_id).bytes
+        except ValueError:
+            return request_id
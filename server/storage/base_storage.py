@@ -0,0 +1,29 @@
+from common import canonical_json
+
+
+class BaseStorage:
+    store_id = None
+
+    def open(self):
+        raise NotImplementedError()
+
+    def load(self, start=0):
+        raise NotImplementedError()
+
+    def load_raw(self, start=0):
+        return (canonical_json.encode_bytes(message) for message in self.load(start))
+
+    def read(self, offset):
+        raise NotImplementedError()
+
+    def read_raw(self, offset):
+        return canonical_json.encode_bytes(self.read(offset))
+
+    def append(self, messages, encoded=None):
+        raise NotImplementedError()
+
+    def sync(self):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
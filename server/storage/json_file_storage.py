@@ -0,0 +1,40 @@
+import json, os.path
+from server.storage.base_storage import BaseStorage
+
+
+class JsonFileStorage(BaseStorage):
+    """
+    The original storage format - the complete message list is held in a single JSON file which is rewritten
+    every time a message is added. Only suitable for very small stores, use LogStorage for anything else.
+    """
+    file_path = 'store.json'
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path or JsonFileStorage.file_path
+        self.messages = []
+
+    def open(self):
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as file:
+                self.messages = json.load(file)
+
+    @property
+    def count(self):
+        return len(self.messages)
+
+    def load(self, start=0):
+        return list(self.messages[start:])
+
+    def read(self, offset):
+        return self.messages[offset]
+
+    def append(self, messages, encoded=None):
+        self.messages.extend(messages)
+        with open(self.file_path, 'w') as file:
+            json.dump(self.messages, file, indent=4)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,343 @@
+import json, os, sys, time, mmap, struct, uuid
+from array import array
+from bisect import bisect_right
+from os.path import join, exists, getsize
+from common import canonical_json
+from common.logging import log, LogLevel
+from server.storage.base_storage import BaseStorage
+from server.storage.json_file_storage import JsonFileStorage
+
+INDEX_ENTRY = struct.Struct('<Q')
+
+
+def positions_to_bytes(positions):
+    positions = array('Q', positions)
+    if sys.byteorder != 'little':
+        positions.byteswap()
+    return positions.tobytes()
+
+
+def positions_from_bytes(data):
+    positions = array('Q')
+    positions.frombytes(data[:len(data) - len(data) % INDEX_ENTRY.size])
+    if sys.byteorder != 'little':
+        positions.byteswap()
+    return positions
+
+
+class MappedSegment:
+    """
+    A segment that is no longer being written to. Its log and index files are memory-mapped, so opening it costs the
+    same however many records it holds, and only the pages containing records that are actually read get loaded.
+    """
+    def __init__(self, log_path, index_path):
+        self.log_map = self._map(log_path)
+        self.index_map = self._map(index_path)
+        self.length = len(self.index_map) // INDEX_ENTRY.size
+
+    def __len__(self):
+        return self.length
+
+    def read(self, i):
+        start = INDEX_ENTRY.unpack_from(self.index_map, i * INDEX_ENTRY.size)[0]
+        end = INDEX_ENTRY.unpack_from(self.index_map, (i + 1) * INDEX_ENTRY.size)[0] if i + 1 < self.length else len(self.log_map)
+        return self.log_map[start:end - 1]
+
+    def close(self):
+        for file_map in (self.log_map, self.index_map):
+            if isinstance(file_map, mmap.mmap):
+                file_map.close()
+
+    def _map(self, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class OpenSegment:
+    """
+    The segment that is being written to, or the last segment of a read-only log. The file is still growing, so
+    record positions are held in memory and records are read with pread rather than through a memory map. A segment
+    stays open after the log moves on to a new one, readers may still be using it.
+    """
+    def __init__(self, log_path, positions, size):
+        self.file = open(log_path, 'rb')
+        self.positions = positions
+        self.size = size
+
+    def __len__(self):
+        return len(self.positions)
+
+    def read(self, i):
+        start = self.positions[i]
+        end = self.positions[i + 1] if i + 1 < len(self.positions) else self.size
+        return os.pread(self.file.fileno(), end - start - 1, start)
+
+    def close(self):
+        self.file.close()
+
+
+class LogStorage(BaseStorage):
+    """
+    Append-only message log stored as a series of segment files, each containing one message per line, encoded as
+    canonical JSON (see common.canonical_json) so that a stored line can be hashed or sent to clients as it is.
+    Segments are named after the offset of the first message they contain, and a new segment is started once the
+    active one reaches `segment_size` bytes. Adding messages costs a single append to the active segment, however
+    large the store is.
+
+    Each segment has an index file alongside it holding the byte position of every record in the segment as a
+    fixed-width 8-byte integer, so any record can be read by its offset without reading the ones before it. Sealed
+    segments are memory-mapped when the log is opened, only the last segment is checked and its index brought up to
+    date. Indexes missing from logs written by older versions are built the first time the log is opened.
+
+    The log is given a random `store_id` when it is created, so that clients holding copies of its messages can tell
+    when it has been replaced by a different log.
+
+    Writes are flushed to the OS immediately, but fsync is only called once `fsync_every` messages have been written
+    or `fsync_interval` seconds have passed since the last sync, so a power failure can lose at most that many
+    messages. A process crash can leave a partially written line at the end of the log, this is discarded when the
+    log is next opened. A read-only storage never modifies the log, it just ignores any incomplete final line.
+    """
+    dir_path = 'store'
+    segment_extension = '.log'
+    index_extension = '.idx'
+    store_id_file_name = 'store.id'
+    migration_chunk_size = 1000
+
+    def __init__(self, dir_path=None, segment_size=64 * 1024 * 1024, fsync_every=100, fsync_interval=1.0, legacy_file_path=None, read_only=False):
+        self.dir_path = dir_path or LogStorage.dir_path
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.legacy_file_path = JsonFileStorage.file_path if legacy_file_path is None else legacy_file_path
+        self.segments = []
+        self.readers = []
+        self.count = 0
+        self.active_file = None
+        self.active_index_file = None
+        self.active_size = 0
+        self.unsynced_count = 0
+        self.last_sync = time.monotonic()
+        self.read_only = read_only
+
+    def open(self):
+        store_id_path = join(self.dir_path, LogStorage.store_id_file_name)
+        if self.read_only:
+            if exists(self.dir_path):
+                self._open_segments()
+            if exists(store_id_path):
+                self.store_id = self._read_store_id(store_id_path)
+            return
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        if not exists(store_id_path):
+            with open(store_id_path, 'w') as file:
+                file.write(str(uuid.uuid4()))
+        self.store_id = self._read_store_id(store_id_path)
+        self._open_segments()
+        if self.segments:
+            self._open_active_segment()
+        else:
+            self.segments = [0]
+            self._open_active_segment()
+            self.readers = [OpenSegment(self._segment_path(0), array('Q'), 0)]
+
+        if self.count == 0 and self.legacy_file_path and exists(self.legacy_file_path):
+            self._migrate_legacy_file()
+
+    def load(self, start=0):
+        return (json.loads(encoded) for encoded in self.load_raw(start))
+
+    def load_raw(self, start=0):
+        first_segment = max(bisect_right(self.segments, start) - 1, 0)
+        for base_offset, reader in list(zip(self.segments, self.readers))[first_segment:]:
+            for i in range(max(start - base_offset, 0), len(reader)):
+                yield reader.read(i)
+
+    def read(self, offset):
+        return json.loads(self.read_raw(offset))
+
+    def read_raw(self, offset):
+        segment_number = bisect_right(self.segments, offset) - 1
+        return self.readers[segment_number].read(offset - self.segments[segment_number])
+
+    def append(self, messages, encoded=None):
+        if self.read_only:
+            raise ValueError('Unable to add messages to read-only storage {}'.format(self.dir_path))
+
+        if self.active_size >= self.segment_size:
+            self._roll_segment()
+
+        if encoded is None:
+            encoded = [canonical_json.encode_bytes(message) for message in messages]
+        lines = [record + b'\n' for record in encoded]
+        positions = array('Q')
+        position = self.active_size
+        for line in lines:
+            positions.append(position)
+            position += len(line)
+
+        data = b''.join(lines)
+        try:
+            self.active_file.write(data)
+            self.active_file.flush()
+            self.active_index_file.write(positions_to_bytes(positions))
+            self.active_index_file.flush()
+        except Exception:
+            self._discard_unflushed_data()
+            raise
+
+        active_reader = self.readers[-1]
+        active_reader.positions.extend(positions)
+        self.active_size += len(data)
+        active_reader.size = self.active_size
+        self.count += len(messages)
+        self.unsynced_count += len(messages)
+
+        if self.unsynced_count >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.active_file and self.unsynced_count:
+            os.fsync(self.active_file.fileno())
+        self.unsynced_count = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self._close_active_segment()
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
+
+    def _close_active_segment(self):
+        if self.active_file:
+            self.sync()
+            self.active_file.close()
+            self.active_file = None
+        if self.active_index_file:
+            # sealed segments are trusted when the log is opened, so their indexes must be on disk
+            os.fsync(self.active_index_file.fileno())
+            self.active_index_file.close()
+            self.active_index_file = None
+
+    def _discard_unflushed_data(self):
+        for file in (self.active_file, self.active_index_file):
+            try:
+                file.close()
+            except OSError:
+                pass
+        base_offset = self.segments[-1]
+        with open(self._segment_path(base_offset), 'r+b') as file:
+            file.truncate(self.active_size)
+        with open(self._index_path(base_offset), 'r+b') as file:
+            file.truncate(len(self.readers[-1]) * INDEX_ENTRY.size)
+        self._open_active_segment()
+
+    def _read_store_id(self, store_id_path):
+        with open(store_id_path, 'r') as file:
+            return file.read().strip()
+
+    def _find_segments(self):
+        return sorted(int(file_name[:-len(LogStorage.segment_extension)]) for file_name in os.listdir(self.dir_path)
+                      if file_name.endswith(LogStorage.segment_extension))
+
+    def _segment_path(self, base_offset):
+        return join(self.dir_path, '{:020d}{}'.format(base_offset, LogStorage.segment_extension))
+
+    def _index_path(self, base_offset):
+        return join(self.dir_path, '{:020d}{}'.format(base_offset, LogStorage.index_extension))
+
+    def _open_segments(self):
+        self.segments = self._find_segments()
+        self.readers = [self._open_sealed_segment(base_offset, next_base_offset - base_offset)
+                        for base_offset, next_base_offset in zip(self.segments, self.segments[1:])]
+        if self.segments:
+            self.readers.append(self._open_last_segment(self.segments[-1]))
+            self.count = self.segments[-1] + len(self.readers[-1])
+
+    def _open_sealed_segment(self, base_offset, count):
+        segment_path = self._segment_path(base_offset)
+        index_path = self._index_path(base_offset)
+        if not exists(index_path) or getsize(index_path) != count * INDEX_ENTRY.size:
+            positions, size = self._scan_positions(base_offset, array('Q'), 0)
+            if self.read_only:
+                return OpenSegment(segment_path, positions, size)
+            log(LogLevel.INFO, 'Building index for {}'.format(segment_path))
+            self._write_index(base_offset, positions)
+        return MappedSegment(segment_path, index_path)
+
+    def _open_last_segment(self, base_offset):
+        segment_path = self._segment_path(base_offset)
+        index_path = self._index_path(base_offset)
+        indexed_positions = array('Q')
+        if exists(index_path):
+            with open(index_path, 'rb') as file:
+                indexed_positions = positions_from_bytes(file.read())
+
+        # the index is written after the log, so after a crash it may be missing the last few records, or point past
+        # the end of the log if the log lost data that the index did not - only the records after the last indexed
+        # one that is still in the log need to be checked, along with that record itself
+        file_length = getsize(segment_path)
+        positions = array('Q', indexed_positions)
+        while positions and positions[-1] >= file_length:
+            positions.pop()
+        scan_start = positions.pop() if positions else 0
+        positions, valid_length = self._scan_positions(base_offset, positions, scan_start)
+
+        if not self.read_only:
+            if valid_length < file_length:
+                log(LogLevel.WARN, 'Discarding {} bytes of incomplete data from the end of {}'.format(file_length - valid_length, segment_path))
+                with open(segment_path, 'r+b') as file:
+                    file.truncate(valid_length)
+                    os.fsync(file.fileno())
+            if positions != indexed_positions:
+                self._write_index(base_offset, positions)
+
+        return OpenSegment(segment_path, positions, valid_length)
+
+    def _scan_positions(self, base_offset, positions, start):
+        position = start
+        with open(self._segment_path(base_offset), 'rb') as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                positions.append(position)
+                position += len(line)
+        return positions, position
+
+    def _write_index(self, base_offset, positions):
+        index_path = self._index_path(base_offset)
+        temp_path = index_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(positions_to_bytes(positions))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, index_path)
+
+    def _open_active_segment(self):
+        base_offset = self.segments[-1]
+        segment_path = self._segment_path(base_offset)
+        self.active_file = open(segment_path, 'ab')
+        self.active_index_file = open(self._index_path(base_offset), 'ab')
+        self.active_size = getsize(segment_path)
+
+    def _roll_segment(self):
+        self._close_active_segment()
+        self.segments.append(self.count)
+        self._open_active_segment()
+        self.readers.append(OpenSegment(self._segment_path(self.count), array('Q'), 0))
+
+    def _migrate_legacy_file(self):
+        with open(self.legacy_file_path, 'r') as file:
+            messages = json.load(file)
+        for i in range(0, len(messages), LogStorage.migration_chunk_size):
+            self.append(messages[i:i + LogStorage.migration_chunk_size])
+        self.sync()
+        os.rename(self.legacy_file_path, self.legacy_file_path + '.migrated')
+        log(LogLevel.INFO, 'Migrated {} messages from {} to {}'.format(len(messages), self.legacy_file_path, self.dir_path))
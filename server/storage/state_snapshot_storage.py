@@ -0,0 +1,66 @@
+import os, pickle, gc
+from os.path import join, exists
+from common.logging import log, LogLevel
+from server.storage.log_storage import LogStorage
+
+
+class StateSnapshotStorage:
+    """
+    Saves snapshots of the state the message store derives from the log (its indexes, registrations and checkpoint
+    state), each labelled with the number of log records it covers, so that a restarting server only has to replay
+    the records added after the latest snapshot. Snapshots are pickled, they are written and read only by the server
+    itself and live alongside the log they describe. Only the newest `keep` snapshots are kept.
+    """
+    snapshot_extension = '.state'
+
+    def __init__(self, dir_path=None, keep=2):
+        self.dir_path = dir_path or LogStorage.dir_path
+        self.keep = keep
+
+    def save(self, position, state):
+        os.makedirs(self.dir_path, exist_ok=True)
+        snapshot_path = self._snapshot_path(position)
+        temp_path = snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, snapshot_path)
+
+        for old_position in self._find_snapshots()[:-self.keep]:
+            os.remove(self._snapshot_path(old_position))
+
+    def load_latest(self, max_position):
+        """
+        Returns (position, state) for the newest readable snapshot covering no more than `max_position` records, or
+        None if there isn't one.
+        """
+        for position in reversed(self._find_snapshots()):
+            if position > max_position:
+                continue
+            try:
+                return position, self._load(position)
+            except Exception as ex:
+                log(LogLevel.WARN, 'Unable to read state snapshot {} - {}'.format(self._snapshot_path(position), ex))
+        return None
+
+    def _load(self, position):
+        # unpickling creates millions of small objects, none of which can be garbage, so the collector is paused
+        # rather than letting it repeatedly scan them
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(self._snapshot_path(position), 'rb') as file:
+                return pickle.load(file)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _find_snapshots(self):
+        if not exists(self.dir_path):
+            return []
+        return sorted(int(file_name[:-len(StateSnapshotStorage.snapshot_extension)]) for file_name in os.listdir(self.dir_path)
+                      if file_name.endswith(StateSnapshotStorage.snapshot_extension))
+
+    def _snapshot_path(self, position):
+        return join(self.dir_path, '{:020d}{}'.format(position, StateSnapshotStorage.snapshot_extension))
@@ -0,0 +1,167 @@
+import os, json, threading
+from os.path import join, exists
+from common import canonical_json
+from common.logging import log, LogLevel
+from server.storage.log_storage import LogStorage
+
+ENCODING = 'utf-8'
+
+
+class WorkJournal:
+    """
+    Write-ahead journal of the work items accepted by the server, so that items that had been accepted but not yet
+    processed when the server stopped are processed when it starts again. Each item is appended to the journal as a
+    line of JSON before the server acknowledges it. Callers wait in `wait_until_durable` until an fsync has covered
+    their item, and one fsync covers every item written before it started (group commit), so many concurrent requests
+    share the cost of each sync.
+
+    Once items have been processed they are marked as completed, and a journal file is deleted by `release` when all
+    the items in it are complete. A new file is started once the current one reaches `segment_size` bytes. The file
+    being written to is truncated instead, once every item in it is complete. `release` should only be called once the
+    message store has been synced, so that no item is dropped from the journal before it is safely in the store.
+
+    When the journal is opened, the items left in the files from the last run that were never completed are read
+    into `recovered`, they are written again to a new file by the caller and the old files are then removed by
+    `discard_recovered`.
+    """
+    dir_path = join(LogStorage.dir_path, 'journal')
+    segment_extension = '.journal'
+
+    def __init__(self, dir_path=None, segment_size=16 * 1024 * 1024):
+        self.dir_path = dir_path or WorkJournal.dir_path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.sync_condition = threading.Condition()
+        self.syncing = False
+        self.written_count = 0
+        self.synced_count = 0
+        self.segments = {}
+        self.segment_of = {}
+        self.active_segment = None
+        self.active_fd = None
+        self.active_size = 0
+        self.recovered = []
+        self.recovered_paths = []
+
+    def open(self):
+        os.makedirs(self.dir_path, exist_ok=True)
+        segment_numbers = self._find_segments()
+        self.recovered_paths = [self._segment_path(number) for number in segment_numbers]
+        self.recovered = self._read_unfinished_items(self.recovered_paths)
+        if self.recovered:
+            log(LogLevel.INFO, 'Recovered {} unprocessed work items from {}'.format(len(self.recovered), self.dir_path))
+        self._start_segment(segment_numbers[-1] + 1 if segment_numbers else 0)
+
+    def write(self, item):
+        """
+        Appends the item to the journal, returning a position to pass to `wait_until_durable`.
+        """
+        line = canonical_json.encode_bytes(item) + b'\n'
+        with self.lock:
+            if self.active_size >= self.segment_size:
+                self._start_segment(self.active_segment + 1)
+            self._write_line(line)
+            self.segments[self.active_segment] += 1
+            self.segment_of[item['requestId']] = self.active_segment
+            return self.written_count
+
+    def complete(self, items):
+        """
+        Marks the items as processed, returning a position to pass to `wait_until_durable`.
+        """
+        with self.lock:
+            self._write_line(canonical_json.encode_bytes({'done': [item['requestId'] for item in items]}) + b'\n')
+            for item in items:
+                segment = self.segment_of.pop(item['requestId'], None)
+                if segment is not None:
+                    self.segments[segment] -= 1
+            return self.written_count
+
+    def wait_until_durable(self, position):
+        with self.sync_condition:
+            while self.synced_count < position:
+                if self.syncing:
+                    self.sync_condition.wait()
+                    continue
+
+                # no sync is in progress, so this thread syncs everything written so far on behalf of all the waiters
+                self.syncing = True
+                self.sync_condition.release()
+                try:
+                    with self.lock:
+                        target = self.written_count
+                        fd = os.dup(self.active_fd)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                finally:
+                    self.sync_condition.acquire()
+                    self.syncing = False
+                    self.sync_condition.notify_all()
+                self.synced_count = max(self.synced_count, target)
+
+    def release(self):
+        with self.lock:
+            for segment, pending_count in list(self.segments.items()):
+                if pending_count == 0 and segment != self.active_segment:
+                    del self.segments[segment]
+                    self._remove(self._segment_path(segment))
+            if len(self.segments) == 1 and self.segments[self.active_segment] == 0 and self.active_size:
+                os.ftruncate(self.active_fd, 0)
+                self.active_size = 0
+
+    def discard_recovered(self):
+        for path in self.recovered_paths:
+            self._remove(path)
+        self.recovered = []
+        self.recovered_paths = []
+
+    def close(self):
+        with self.lock:
+            if self.active_fd is not None:
+                os.close(self.active_fd)
+                self.active_fd = None
+
+    def _start_segment(self, number):
+        # the items in the previous file must be durable before it stops being the one that gets synced
+        if self.active_fd is not None:
+            os.fsync(self.active_fd)
+            os.close(self.active_fd)
+        self.active_segment = number
+        self.active_fd = os.open(self._segment_path(number), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.active_size = 0
+        self.segments[number] = 0
+
+    def _write_line(self, line):
+        os.write(self.active_fd, line)
+        self.active_size += len(line)
+        self.written_count += 1
+
+    def _read_unfinished_items(self, paths):
+        items = {}
+        done = set()
+        for path in paths:
+            with open(path, 'rb') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut short if the server stopped while it was being written
+                        break
+                    if 'done' in record:
+                        done.update(record['done'])
+                    else:
+                        items.setdefault(record['requestId'], record)
+        return [item for request_id, item in items.items() if request_id not in done]
+
+    def _find_segments(self):
+        return sorted(int(file_name[:-len(WorkJournal.segment_extension)]) for file_name in os.listdir(self.dir_path)
+                      if file_name.endswith(WorkJournal.segment_extension))
+
+    def _segment_path(self, number):
+        return join(self.dir_path, '{:020d}{}'.format(number, WorkJournal.segment_extension))
+
+    def _remove(self, path):
+        if exists(path):
+            os.remove(path)
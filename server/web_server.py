@@ -1,26 +1,149 @@
 from bottle import Bottle, ServerAdapter, request, HTTPResponse, response
-import uuid, json
+import uuid, json, time, socket
+from itertools import islice
 
-from server.message_store import MessageStore
-from .exception import InvalidRequest
+from .exception import InvalidRequest, QueueFullError
+from common.crypto_utils import public_key_cache
+from common.merkle import data_leaf_hash, audit_paths
+from .query_engine import QueryEngine
+from .status_tracker import StatusEntry, status_for_code, SUCCESS_CODE, PENDING_CODE
 
 from common.logging import log, LogLevel
-from wsgiref.simple_server import make_server, WSGIRequestHandler
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer, ServerHandler
+from queue import Queue
+import threading
+
+ENCODING = 'utf-8'
+QUERY_OPTIONS = ['limit', 'after', 'stream']
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_STATUS_WAIT = 60
+MAX_BATCH_MESSAGES = 1000
+SINGLE_THREADED = 'single'
+THREADED = 'threaded'
 
 class QuietHandler(WSGIRequestHandler):
     def log_request(*args, **kwargs):
         pass
 
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        # without a length the client can only tell where the body ends when the connection closes
+        if 'Content-Length' not in self.headers:
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = True
+
+class KeepAliveHandler(QuietHandler):
+    """
+    Handles a series of HTTP/1.1 requests on the same connection, until the client closes it, asks for it to be
+    closed, or leaves it idle for `timeout` seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        self._handle_one_request()
+        while not self.close_connection:
+            self._handle_one_request()
+
+    def _handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except TimeoutError:
+            self.close_connection = True
+            return
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    WSGI server which hands each connection over to one of a fixed number of worker threads, so a slow request only
+    holds up the connection it arrived on. When the server is closed, connections that are being kept alive are shut
+    down for reading so that clients cannot go on sending requests to a server that has stopped.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, thread_count):
+        super().__init__(server_address, handler_class)
+        self.connections = Queue()
+        self.open_requests = set()
+        self.open_requests_lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(thread_count)]
+        for worker in self.workers:
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.connections.put(None)
+        with self.open_requests_lock:
+            for request in self.open_requests:
+                try:
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+    def _work(self):
+        while True:
+            connection = self.connections.get()
+            if connection is None:
+                return
+
+            request, client_address = connection
+            with self.open_requests_lock:
+                self.open_requests.add(request)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self.open_requests_lock:
+                    self.open_requests.discard(request)
+                self.shutdown_request(request)
+
 class Adapter(ServerAdapter):
-    def __init__ (self, host, port):
+    def __init__ (self, host, port, mode=SINGLE_THREADED, thread_count=16):
         self.server = None
         self.host = host
         self.port = port
+        self.mode = mode
+        self.thread_count = thread_count
         self.options = {}
 
     def run(self, handler):
-        self.options['handler_class'] = QuietHandler
-        self.server = make_server(self.host, self.port, handler, **self.options)
+        if self.mode == THREADED:
+            self.server = ThreadPoolWSGIServer((self.host, self.port), KeepAliveHandler, self.thread_count)
+            self.server.set_app(handler)
+        elif self.mode == SINGLE_THREADED:
+            self.options['handler_class'] = QuietHandler
+            self.server = make_server(self.host, self.port, handler, **self.options)
+        else:
+            raise ValueError("Unknown server mode '{}'".format(self.mode))
         self.server.serve_forever()
 
     def stop(self):
@@ -28,10 +151,16 @@ class Adapter(ServerAdapter):
         self.server.server_close()
 
 class WebServer:
-    def __init__(self, host, port, work_queue):
-        self.server_adapter = Adapter(host, port)
+    def __init__(self, host, port, work_queue, message_store, retry_after=1, mode=SINGLE_THREADED, thread_count=16, server_key=None):
+        self.server_adapter = Adapter(host, port, mode, thread_count)
+        self.retry_after = retry_after
+        self.server_key = server_key
+        self.signed_tree_head = None
+        self.tree_head_lock = threading.Lock()
         self._app = Bottle()
         self.work_queue = work_queue
+        self.message_store = message_store
+        self.query_engine = QueryEngine(message_store)
         self._set_routes()
 
     def start(self):
@@ -43,8 +172,13 @@ class WebServer:
     def _set_routes(self):
         self._app.route('/api/register', method="POST", callback=self._register)
         self._app.route('/api/publish', method="POST", callback=self._publish)
+        self._app.route('/api/publish/batch', method="POST", callback=self._publish_batch)
         self._app.route('/api/status/<request_id>', method="GET", callback=self._status)
+        self._app.route('/api/status-stream', method="GET", callback=self._status_stream)
         self._app.route('/api/query', method="GET", callback=self._query)
+        self._app.route('/api/metrics', method="GET", callback=self._metrics)
+        self._app.route('/api/proof/<request_id>', method="GET", callback=self._proof)
+        self._app.route('/api/server-key', method="GET", callback=self._server_key)
 
     def _register(self):
         request_body = request.json
@@ -62,8 +196,7 @@ class WebServer:
             'data': data
         }
 
-        self.work_queue.add(work_item)
-        return HTTPResponse(status=202, body=json.dumps({'requestId': request_id}))
+        return self._enqueue(work_item)
 
     def _publish(self):
         request_body = request.json
@@ -80,43 +213,206 @@ class WebServer:
             'data': data
         }
 
-        self.work_queue.add(work_item)
+        return self._enqueue(work_item)
+
+    def _publish_batch(self):
+        request_body = request.json
+        try:
+            client_id = self._get_request_value(request_body, 'clientId')
+            signature = self._get_request_value(request_body, 'signature')
+            messages = self._get_batch_messages(request_body)
+        except InvalidRequest as e:
+            return HTTPResponse(status=400, body=json.dumps({'error': str(e)}), content_type='application/json')
+
+        root, proofs = audit_paths([data_leaf_hash(data) for data in messages])
+        merkle_root = root.hex()
+        batch_id = str(uuid.uuid4())
+        publications = [{
+            'requestId': str(uuid.uuid4()),
+            'data': data,
+            'batch': {'merkleRoot': merkle_root, 'index': index, 'size': len(messages), 'proof': [node.hex() for node in proof]}
+        } for index, (data, proof) in enumerate(zip(messages, proofs))]
+
+        work_item = {
+            'type': 'publication_batch',
+            'requestId': batch_id,
+            'requestIds': [batch_id] + [publication['requestId'] for publication in publications],
+            'clientId': client_id,
+            'signature': signature,
+            'data': {'merkleRoot': merkle_root},
+            'publications': publications
+        }
+
+        response = self._enqueue(work_item)
+        if response.status_code == 202:
+            response.body = json.dumps({'requestId': batch_id, 'requestIds': work_item['requestIds'][1:]})
+        return response
+
+    def _get_batch_messages(self, request_body):
+        messages = self._get_request_value(request_body, 'messages')
+        if not isinstance(messages, list) or not messages:
+            raise InvalidRequest("Key 'messages' must be a non-empty list")
+        if len(messages) > MAX_BATCH_MESSAGES:
+            raise InvalidRequest('A batch can hold at most {} messages'.format(MAX_BATCH_MESSAGES))
+        if not all(isinstance(data, dict) for data in messages):
+            raise InvalidRequest("Each item in 'messages' must be an object")
+        return messages
+
+    def _enqueue(self, work_item):
+        try:
+            self.work_queue.add(work_item)
+        except QueueFullError as e:
+            return HTTPResponse(status=503, body=json.dumps({'error': str(e)}), content_type='application/json', headers={'Retry-After': str(self.retry_after)})
+
+        return HTTPResponse(status=202, body=json.dumps({'requestId': work_item['requestId']}))
+
+    def _metrics(self):
+        metrics = {'workQueue': self.work_queue.metrics(), 'publicKeyCache': public_key_cache.stats()}
+        return HTTPResponse(status=200, body=json.dumps(metrics), content_type='application/json')
+
+    def _server_key(self):
+        return HTTPResponse(status=200, body=json.dumps({'publicKey': self.server_key.public_key_pem()}), content_type='application/json')
+
+    def _proof(self, request_id):
+        snapshot = self.message_store.snapshot()
+        offsets = snapshot.get_offsets('requestId', request_id)
+        if not offsets:
+            return HTTPResponse(status=404, body=json.dumps({'error': "No message with requestId '{}' was found".format(request_id)}), content_type='application/json')
+
+        offset = offsets[0]
+        audit_path, root = snapshot.get_inclusion_proof(offset)
+        tree_head, signature = self._get_signed_tree_head(len(snapshot), root)
+        proof = {
+            'requestId': request_id,
+            'index': offset,
+            'record': snapshot.get(offset),
+            'proof': [node.hex() for node in audit_path],
+            'treeHead': tree_head,
+            'treeHeadSignature': signature
+        }
+        return HTTPResponse(status=200, body=json.dumps(proof), content_type='application/json')
 
-        return HTTPResponse(status=202, body=json.dumps({'requestId': request_id}))
+    def _get_signed_tree_head(self, size, root):
+        # signing is slow, so a tree head is only signed once for each size the tree reaches
+        with self.tree_head_lock:
+            if self.signed_tree_head is None or self.signed_tree_head[0]['size'] != size:
+                tree_head = {'size': size, 'merkleRoot': root.hex(), 'timestamp': int(time.time())}
+                self.signed_tree_head = (tree_head, self.server_key.sign(tree_head))
+            return self.signed_tree_head
 
     def _status(self, request_id):
-        request_status = self.work_queue.query(request_id)
+        try:
+            wait = self._get_wait_param(request.query.decode())
+        except InvalidRequest as e:
+            return HTTPResponse(status=400, body=json.dumps({'error': str(e)}), content_type='application/json')
+
+        status = self.work_queue.wait_for(request_id, wait) if wait else self.work_queue.query_details(request_id)
+        return HTTPResponse(status=200, body=json.dumps(self._build_status(request_id, status)))
+
+    def _status_stream(self):
+        params = request.query.decode()
+        try:
+            wait = self._get_wait_param(params)
+        except InvalidRequest as e:
+            return HTTPResponse(status=400, body=json.dumps({'error': str(e)}), content_type='application/json')
+        request_ids = [request_id for request_id in params.get('ids', '').split(',') if request_id]
+
+        headers = {'Cache-Control': 'no-cache'}
+        return HTTPResponse(status=200, body=self._status_events(request_ids, wait), content_type='text/event-stream', headers=headers)
+
+    def _status_events(self, request_ids, wait):
+        deadline = time.monotonic() + wait
+        pending_ids = list(request_ids)
+        while True:
+            still_pending_ids = []
+            for request_id in pending_ids:
+                status = self.work_queue.query_details(request_id)
+                if status is None or status.code != PENDING_CODE:
+                    yield 'data: {}\n\n'.format(json.dumps(self._build_status(request_id, status))).encode(ENCODING)
+                else:
+                    still_pending_ids.append(request_id)
+
+            pending_ids = still_pending_ids
+            remaining = deadline - time.monotonic()
+            if not pending_ids or remaining <= 0:
+                break
+            self.work_queue.wait_for_any(pending_ids, remaining)
 
-        return HTTPResponse(status=200, body=json.dumps({'requestId': request_id, 'status': request_status.name}))
+        for request_id in pending_ids:
+            yield 'data: {}\n\n'.format(json.dumps(self._build_status(request_id, self.work_queue.query_details(request_id)))).encode(ENCODING)
+
+    def _build_status(self, request_id, status):
+        if status is None and self.message_store.snapshot().get_offsets('requestId', request_id):
+            status = StatusEntry(SUCCESS_CODE)
+
+        code = status.code if status else None
+        description = status.description if status else None
+        return {'requestId': request_id, 'status': status_for_code(code).name, 'code': code, 'description': description}
+
+    def _get_wait_param(self, params):
+        wait = self._get_int_param(params, 'wait', 0)
+        return min(wait, MAX_STATUS_WAIT) if wait else 0
 
     def _query(self):
-        def build_query_fn(key, value):
-            key_path = key.split('.')
+        params = request.query.decode()
+        try:
+            limit = self._get_int_param(params, 'limit', 1)
+            after = self._get_int_param(params, 'after', 0)
+        except InvalidRequest as e:
+            return HTTPResponse(status=400, body=json.dumps({'error': str(e)}), content_type='application/json')
+        stream = params.get('stream') in ('1', 'true')
+
+        criteria = [(k, v) for k, v in params.allitems() if k not in QUERY_OPTIONS]
+        query_plan = self.query_engine.plan(criteria)
+        offsets = query_plan.matching_offsets(after)
+        headers = {'X-Query-Plan': query_plan.describe()}
+        if self.message_store.store_id:
+            headers['X-Store-Id'] = self.message_store.store_id
+
+        if limit is not None:
+            offsets = list(islice(offsets, limit + 1))
+            if len(offsets) > limit:
+                offsets = offsets[:limit]
+                headers['X-Next-Cursor'] = str(offsets[-1])
+            headers['X-Rows-Examined'] = str(query_plan.rows_examined)
 
-            def query_fn(obj):
-                target_obj = obj
-                for key_part in key_path:
-                    if key_part in target_obj:
-                        target_obj = target_obj[key_part]
-                    else:
-                        return False
-                return target_obj == value
+        # the encoded records are written out as they are stored, rather than being decoded and encoded again
+        records = (query_plan.snapshot.get_raw(offset) for offset in offsets)
+        if stream:
+            return HTTPResponse(status=200, body=self._ndjson_chunks(records), content_type='application/x-ndjson', headers=headers)
 
-            return query_fn
+        body = b'[' + b', '.join(records) + b']'
+        headers['X-Rows-Examined'] = str(query_plan.rows_examined)
+        return HTTPResponse(status=200, body=body, content_type='application/json', headers=headers)
 
-        query_fns = []
-        for k, v in request.query.decode().items():
-            query_fns.append(build_query_fn(k, v))
+    def _ndjson_chunks(self, records):
+        lines = []
+        chunk_length = 0
+        for record in records:
+            lines.append(record)
+            lines.append(b'\n')
+            chunk_length += len(record) + 1
+            if chunk_length >= STREAM_CHUNK_SIZE:
+                yield b''.join(lines)
+                lines = []
+                chunk_length = 0
+        if lines:
+            yield b''.join(lines)
 
-        matching_messages = list(filter(lambda msg: all([qf(msg) for qf in query_fns]), self._get_messages()))
-        response.content_type = 'application/json'
-        return HTTPResponse(status=200, body=json.dumps(matching_messages), content_type='application/json')
+    def _get_int_param(self, params, name, min_value):
+        if name not in params:
+            return None
+        try:
+            value = int(params[name])
+        except ValueError:
+            raise InvalidRequest("Parameter '{}' must be an integer".format(name))
+        if value < min_value:
+            raise InvalidRequest("Parameter '{}' must be at least {}".format(name, min_value))
+        return value
 
     def _get_request_value(self, request, key):
         if key in request:
             return request[key]
         raise InvalidRequest("Key '{}' missing from request".format(key))
 
-    def _get_messages(self):
-        return MessageStore().get_all()
 
@@ -1,36 +1,188 @@
-from enum import Enum
-from queue import Queue
+import time, threading
+from contextlib import nullcontext
+from itertools import count
+from queue import PriorityQueue, Empty, Full
 from common.logging import log, LogLevel
+from server.exception import QueueFullError, DuplicateRegistrationError
+from server.status_tracker import StatusTracker, RequestStatus, status_for_code, SUCCESS_CODE, REJECTED_CODE, DUPLICATE_CODE, ERROR_CODE
+
+DEFAULT_PRIORITY = 1
+PRIORITIES = {'registration': 0}
+
+
+def request_ids_for(item):
+    """
+    Returns the ids whose statuses follow the item - a batch of publications carries its own id as well as one for
+    each message, and they all succeed or fail together.
+    """
+    return item.get('requestIds', [item['requestId']])
 
 
 class WorkQueue:
-    def __init__(self):
-        self.queue = Queue()
-        self.request_statuses = {}
+    """
+    Holds work items until the request processor is ready for them. Once `high_water_mark` items are waiting, new
+    items are refused with a QueueFullError so that callers can shed load, except for items with a higher priority
+    than the default (ie registrations) which are accepted until the queue reaches `capacity`. Higher priority items
+    are also taken from the queue first, otherwise items are taken in the order they were added.
+
+    If a `journal` is supplied, `add` only returns once the item has been safely written to it, and items are marked
+    as complete in the journal once they have been processed. Items left unprocessed in the journal by the last run
+    are put back on the queue by `recover`.
+    """
+    def __init__(self, capacity=100000, high_water_mark=None, status_ttl=3600, journal=None):
+        self.capacity = capacity
+        self.high_water_mark = capacity if high_water_mark is None else min(high_water_mark, capacity)
+        self.queue = PriorityQueue(maxsize=capacity)
+        self.sequence = count()
+        self.request_statuses = StatusTracker(status_ttl)
+        self.metrics_lock = threading.Lock()
+        self.added_count = 0
+        self.rejected_count = 0
+        self.taken_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.journal = journal
+        if self.journal:
+            self.journal.open()
+
+    def recover(self, is_processed):
+        """
+        Puts the items that were left unprocessed in the journal back on the queue, skipping any for which
+        `is_processed` returns True because they reached the message store before the journal was updated.
+        """
+        if not self.journal:
+            return 0
+        items = [item for item in self.journal.recovered if not is_processed(item)]
+        position = 0
+        for item in items:
+            for request_id in request_ids_for(item):
+                self.request_statuses.set_pending(request_id)
+            position = self.journal.write(item)
+            self.queue.put((PRIORITIES.get(item['type'], DEFAULT_PRIORITY), next(self.sequence), time.monotonic(), item))
+        self.journal.wait_until_durable(position)
+        self.journal.discard_recovered()
+        return len(items)
+
+    def release_processed(self):
+        """
+        Lets the journal drop items that have been processed. Only call this once the message store has been synced.
+        """
+        if self.journal:
+            self.journal.release()
 
     def add(self, item):
-        request_id = item['requestId']
-        self.request_statuses[request_id] = RequestStatus.PENDING
-        self.queue.put(item, block=False)
+        priority = PRIORITIES.get(item['type'], DEFAULT_PRIORITY)
+        if priority >= DEFAULT_PRIORITY and self.queue.qsize() >= self.high_water_mark:
+            self._reject()
 
-    def process_next(self, handler):
-        item = self.queue.get()
-        request_id = item['requestId']
+        request_ids = request_ids_for(item)
+        for request_id in request_ids:
+            self.request_statuses.set_pending(request_id)
+        journal_position = self.journal.write(item) if self.journal else None
         try:
-            handler(item)
-            self.request_statuses[request_id] = RequestStatus.SUCCESS
-            self.queue.task_done()
+            self.queue.put((priority, next(self.sequence), time.monotonic(), item), block=False)
+        except Full:
+            for request_id in request_ids:
+                self.request_statuses.remove(request_id)
+            if self.journal:
+                self.journal.wait_until_durable(self.journal.complete([item]))
+            self._reject()
+
+        if self.journal:
+            self.journal.wait_until_durable(journal_position)
+
+        with self.metrics_lock:
+            self.added_count += 1
+
+    def metrics(self):
+        with self.metrics_lock:
+            return {
+                'depth': self.queue.qsize(),
+                'capacity': self.capacity,
+                'highWaterMark': self.high_water_mark,
+                'added': self.added_count,
+                'rejected': self.rejected_count,
+                'taken': self.taken_count,
+                'averageWaitSeconds': self.total_wait / self.taken_count if self.taken_count else 0.0,
+                'maxWaitSeconds': self.max_wait
+            }
+
+    def _reject(self):
+        with self.metrics_lock:
+            self.rejected_count += 1
+        raise QueueFullError('The server is too busy to accept more requests, please try again later')
 
-        except Exception as ex :
-            log(LogLevel.ERROR, str(ex))
-            self.request_statuses[request_id] = RequestStatus.FAILURE
+    def _get(self, block=True, timeout=None):
+        priority, sequence, added_time, item = self.queue.get(block=block, timeout=timeout)
+        wait = time.monotonic() - added_time
+        with self.metrics_lock:
+            self.taken_count += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return item
+
+    def get_batch(self, max_items, linger):
+        """
+        Waits for an item to arrive, then keeps taking items until there are `max_items` of them or `linger` seconds
+        have passed since the first one was taken.
+        """
+        items = [self._get()]
+        deadline = time.monotonic() + linger
+        while len(items) < max_items:
+            try:
+                remaining = deadline - time.monotonic()
+                items.append(self._get(block=remaining > 0, timeout=remaining if remaining > 0 else None))
+            except Empty:
+                break
+        return items
+
+    def process_batch(self, items, handler, transaction):
+        """
+        Passes each item to the handler inside the transaction. Items that the handler rejects are marked as failed
+        straight away, the rest are only marked as successful once the transaction has completed.
+        """
+        handled_request_ids = []
+        try:
+            with transaction():
+                for item in items:
+                    request_ids = request_ids_for(item)
+                    try:
+                        handler(item)
+                        handled_request_ids.extend(request_ids)
+
+                    except Exception as ex:
+                        log(LogLevel.ERROR, str(ex))
+                        code = DUPLICATE_CODE if isinstance(ex, DuplicateRegistrationError) else REJECTED_CODE
+                        for request_id in request_ids:
+                            self.request_statuses.complete(request_id, code, str(ex))
+
+            for request_id in handled_request_ids:
+                self.request_statuses.complete(request_id, SUCCESS_CODE)
+
+        except Exception as ex:
+            description = 'Unable to commit batch of {} items - {}'.format(len(items), ex)
+            log(LogLevel.ERROR, description)
+            for request_id in handled_request_ids:
+                self.request_statuses.complete(request_id, ERROR_CODE, description)
+
+        finally:
+            if self.journal:
+                self.journal.complete(items)
+            for _ in items:
+                self.queue.task_done()
+
+    def process_next(self, handler):
+        self.process_batch([self._get()], handler, nullcontext)
 
     def query(self, id):
-        return self.request_statuses.get(id, RequestStatus.UNKNOWN)
+        entry = self.request_statuses.get(id)
+        return status_for_code(entry.code if entry else None)
+
+    def query_details(self, id):
+        return self.request_statuses.get(id)
 
+    def wait_for(self, id, timeout):
+        return self.request_statuses.wait(id, timeout)
 
-class RequestStatus(Enum):
-    UNKNOWN = 0
-    PENDING = 1
-    SUCCESS = 2
-    FAILURE = 3
+    def wait_for_any(self, ids, timeout):
+        return self.request_statuses.wait_any(ids, timeout)
@@ -0,0 +1,43 @@
+import unittest, json, tempfile, shutil
+from os.path import join
+
+from common import canonical_json
+from server.checkpoint import Checkpointer
+from server.message_store import MessageStore
+from server.storage.log_storage import LogStorage
+
+
+class CanonicalJsonTest(unittest.TestCase):
+
+    def test_encoding_matches_signed_form(self):
+        value = {'b': [1, 2.5, None, True], 'a': {'z': 'café ✓', 'y': ''}, 'c': 'line\nbreak'}
+        self.assertEqual(canonical_json.encode(value), json.dumps(value, sort_keys=True))
+        self.assertEqual(canonical_json.encode_bytes(value), json.dumps(value, sort_keys=True).encode('utf-8'))
+
+    def test_non_finite_numbers_rejected(self):
+        with self.assertRaises(ValueError):
+            canonical_json.encode({'value': float('nan')})
+
+    def test_stored_records_kept_in_canonical_form(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            messages = [{'type': 'publication', 'requestId': str(n), 'clientId': 'a', 'data': {'message': 'café'}} for n in range(3)]
+            store = MessageStore(LogStorage(dir_path=join(temp_dir, 'store'), legacy_file_path=''), checkpointer=Checkpointer())
+            store.add(messages[0])
+            with store.batch():
+                store.add(messages[1])
+                store.add(messages[2])
+                self.assertEqual(store.get_raw(2), canonical_json.encode_bytes(messages[2]))
+            self.assertEqual([store.get_raw(n) for n in range(3)], [canonical_json.encode_bytes(message) for message in messages])
+            store.close()
+
+            reopened = MessageStore(LogStorage(dir_path=join(temp_dir, 'store'), legacy_file_path=''), checkpointer=Checkpointer())
+            self.assertEqual(reopened.checkpointer.tree.root(), store.checkpointer.tree.root())
+            self.assertEqual(reopened.get_raw(1), canonical_json.encode_bytes(messages[1]))
+            reopened.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
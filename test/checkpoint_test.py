@@ -0,0 +1,86 @@
+import unittest, tempfile, shutil
+from os.path import join
+
+from common.checkpoint import verify_checkpoints, record_leaf_hash, CHECKPOINT_TYPE
+from common.merkle import root_from_audit_path
+from server.checkpoint import Checkpointer
+from server.message_store import MessageStore
+from server.storage.log_storage import LogStorage
+
+
+def build_publication(msg):
+    return {'type': 'publication', 'requestId': 'p-' + msg, 'clientId': 'a', 'signature': '', 'data': {'message': msg}}
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = self._open_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_hash_record_added_every_n_messages(self):
+        self._given_messages_added(7)
+        self.assertEqual(self._record_types(), ['publication'] * 3 + [CHECKPOINT_TYPE] + ['publication'] * 3 + [CHECKPOINT_TYPE, 'publication'])
+        self.assertEqual(verify_checkpoints(self.store.get_all()), (9, 2, 7))
+
+    def test_hash_record_added_after_interval(self):
+        self.store.close()
+        self.store = self._open_store(interval_messages=1000, interval_seconds=0)
+        self.store.checkpoint_if_due()
+        self.assertEqual(list(self.store.get_all()), [])
+
+        self._given_messages_added(1)
+        self.assertEqual(self._record_types(), ['publication', CHECKPOINT_TYPE])
+
+    def test_altered_message_detected(self):
+        self._given_messages_added(4)
+        messages = [dict(msg) for msg in self.store.get_all()]
+        messages[1]['data'] = {'message': 'altered'}
+        with self.assertRaises(ValueError):
+            verify_checkpoints(messages)
+
+    def test_chain_continues_when_store_reopened(self):
+        self._given_messages_added(4)
+        self.store.close()
+        self.store = self._open_store()
+        self._given_messages_added(4, start=4)
+        self.assertEqual(verify_checkpoints(self.store.get_all()), (10, 2, 7))
+
+    def test_chain_restored_when_batch_fails(self):
+        self._given_messages_added(2)
+        with self.assertRaises(IOError):
+            with self.store.batch():
+                self._given_messages_added(4, start=2)
+                raise IOError('disk full')
+        self._given_messages_added(2, start=6)
+        self.assertEqual(self._record_types(), ['publication'] * 3 + [CHECKPOINT_TYPE, 'publication'])
+        self.assertEqual(verify_checkpoints(self.store.get_all()), (5, 1, 3))
+
+    def test_inclusion_proof_matches_hash_record(self):
+        self._given_messages_added(3)
+        snapshot = self.store.snapshot()
+        self._given_messages_added(2, start=3)
+
+        audit_path, root = snapshot.get_inclusion_proof(1)
+        self.assertEqual(root_from_audit_path(record_leaf_hash(snapshot.get(1)), 1, len(snapshot), audit_path), root)
+        self.assertEqual(len(snapshot), 4)
+        self.assertEqual(self.store.checkpointer.tree.root(3).hex(), snapshot.get(3)['data']['merkleRoot'])
+
+    def _open_store(self, interval_messages=3, interval_seconds=3600):
+        storage = LogStorage(dir_path=join(self.temp_dir, 'store'), legacy_file_path='')
+        return MessageStore(storage, checkpointer=Checkpointer(interval_messages, interval_seconds))
+
+    def _given_messages_added(self, count, start=0):
+        for n in range(start, start + count):
+            self.store.add(build_publication(str(n)))
+
+    def _record_types(self):
+        return [msg['type'] for msg in self.store.get_all()]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest, tempfile, shutil, json, time
+from os.path import join, exists
+from unittest.mock import patch
+
+from client.client_cache import PublicKeyCache
+
+
+class PublicKeyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_path = join(self.temp_dir, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_keys_only_saved_when_flushed(self):
+        cache = PublicKeyCache(self.file_path)
+        cache.add('alice', 'key-a')
+        cache.add('bob', 'key-b')
+        self.assertFalse(exists(self.file_path))
+
+        cache.flush()
+        reopened = PublicKeyCache(self.file_path)
+        self.assertEqual([reopened.get('alice'), reopened.get('bob'), reopened.get('carol')], ['key-a', 'key-b', None])
+        self.assertEqual(reopened.missing(['carol', 'alice', 'carol']), ['carol'])
+
+    def test_expired_keys_ignored(self):
+        cache = PublicKeyCache(self.file_path, ttl=60)
+        cache.add('alice', 'key-a')
+        with patch('client.client_cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('alice'))
+
+    def test_oldest_keys_dropped_when_full(self):
+        cache = PublicKeyCache(self.file_path, max_entries=2)
+        for n, id in enumerate(['alice', 'bob', 'carol']):
+            with patch('client.client_cache.time.time', return_value=1000.0 + n):
+                cache.add(id, 'key-' + id)
+        cache.flush()
+
+        reopened = PublicKeyCache(self.file_path, ttl=None)
+        self.assertEqual(reopened.missing(['alice', 'bob', 'carol']), ['alice'])
+
+    def test_keys_dropped_when_store_changes(self):
+        cache = PublicKeyCache(self.file_path)
+        cache.set_store_id('store-1')
+        cache.add('alice', 'key-a')
+        cache.set_store_id(None)
+        self.assertEqual(cache.get('alice'), 'key-a')
+
+        cache.set_store_id('store-2')
+        self.assertIsNone(cache.get('alice'))
+
+    def test_old_cache_file_format_read(self):
+        with open(self.file_path, 'w') as file:
+            json.dump({'alice': 'key-a'}, file)
+        self.assertEqual(PublicKeyCache(self.file_path).get('alice'), 'key-a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from common.crypto_utils import ParsedKeyCache, sign_data_with_key, verify_signature, batch_merkle_root, verify_batch_signature, \
+    generate_private_key, key_algorithm, KEY_ALGORITHMS
+from common.merkle import data_leaf_hash, audit_paths
+
+ENCODING = 'utf-8'
+
+
+def generate_key():
+    return rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=2048)
+
+
+def public_key_pem(key):
+    return key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode(ENCODING)
+
+
+class CryptoUtilsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [generate_key() for _ in range(3)]
+
+    def test_signature_verified_with_pem_string(self):
+        data = {'message': 'hello'}
+        signature = sign_data_with_key(data, self.keys[0])
+        self.assertTrue(verify_signature(data, signature, public_key_pem(self.keys[0])))
+        self.assertFalse(verify_signature(data, signature, public_key_pem(self.keys[1])))
+        self.assertFalse(verify_signature({'message': 'goodbye'}, signature, public_key_pem(self.keys[0])))
+
+    def test_signature_verified_for_each_key_algorithm(self):
+        data = {'message': 'hello'}
+        keys = {algorithm: generate_private_key(algorithm) for algorithm in KEY_ALGORITHMS[1:]}
+        keys[KEY_ALGORITHMS[0]] = self.keys[0]
+        for algorithm, key in keys.items():
+            self.assertEqual(key_algorithm(key), algorithm)
+            self.assertEqual(key_algorithm(key.public_key()), algorithm)
+            signature = sign_data_with_key(data, key)
+            self.assertTrue(verify_signature(data, signature, public_key_pem(key)))
+            self.assertFalse(verify_signature({'message': 'goodbye'}, signature, public_key_pem(key)))
+            for other_key in keys.values():
+                if other_key is not key:
+                    self.assertFalse(verify_signature(data, signature, other_key.public_key()))
+
+    def test_unknown_key_algorithm_rejected(self):
+        with self.assertRaises(ValueError):
+            generate_private_key('dsa')
+
+    def test_batch_signature_verified_with_audit_path(self):
+        messages = [{'message': str(n)} for n in range(5)]
+        root = batch_merkle_root(messages)
+        signature = sign_data_with_key({'merkleRoot': root}, self.keys[0])
+        _, paths = audit_paths([data_leaf_hash(data) for data in messages])
+        batch = {'merkleRoot': root, 'index': 3, 'size': 5, 'proof': [node.hex() for node in paths[3]]}
+
+        self.assertTrue(verify_batch_signature(messages[3], batch, signature, public_key_pem(self.keys[0])))
+        self.assertFalse(verify_batch_signature(messages[2], batch, signature, public_key_pem(self.keys[0])))
+        self.assertFalse(verify_batch_signature(messages[3], batch, signature, public_key_pem(self.keys[1])))
+        self.assertFalse(verify_batch_signature(messages[3], dict(batch, proof=['zz']), signature, public_key_pem(self.keys[0])))
+
+    def test_parsed_keys_are_cached(self):
+        cache = ParsedKeyCache(2)
+        pems = [public_key_pem(key) for key in self.keys]
+
+        first = cache.get(pems[0])
+        self.assertIs(cache.get(pems[0]), first)
+        cache.get(pems[1])
+        cache.get(pems[0])
+        cache.get(pems[2])
+        self.assertEqual(cache.stats(), {'size': 2, 'maxSize': 2, 'hits': 2, 'misses': 3, 'evictions': 1})
+
+        cache.get(pems[1])
+        self.assertEqual(cache.stats()['misses'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
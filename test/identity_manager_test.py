@@ -0,0 +1,82 @@
+import unittest, tempfile, shutil, threading, os, stat
+from os.path import join
+from unittest.mock import patch
+
+from cryptography.hazmat.primitives import serialization
+
+from client.identity_manager import IdManager, AGENT_SOCKET_FILE_NAME
+from client.key_agent import KeyAgent
+from common.crypto_utils import key_algorithm
+
+PASSWORD = 'secret'
+load_pem_private_key = serialization.load_pem_private_key
+
+
+def public_key_pem(key):
+    return key.public_key().public_bytes(encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+class IdManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key_dir = tempfile.mkdtemp()
+        self.id_manager = IdManager(self.key_dir, PASSWORD)
+        self.id_manager.create('alice', 'ed25519')
+        self.id_manager.create('bob', 'ed25519')
+        self.key_agent = None
+
+    def tearDown(self):
+        if self.key_agent:
+            self.key_agent.stop()
+        shutil.rmtree(self.key_dir)
+
+    def test_keys_only_loaded_when_used(self):
+        with patch('client.identity_manager.serialization.load_pem_private_key', side_effect=load_pem_private_key) as load_key:
+            id_manager = IdManager(self.key_dir, PASSWORD)
+            self.assertEqual(sorted(id_manager.list()), ['alice', 'bob'])
+            self.assertEqual(load_key.call_count, 0)
+
+            self.assertEqual(public_key_pem(id_manager.get_key('alice')), public_key_pem(self.id_manager.get_key('alice')))
+            id_manager.get_key('alice')
+            self.assertEqual(load_key.call_count, 1)
+
+    def test_keys_created_in_bulk(self):
+        created, already_existed = self.id_manager.create_many(['carol', 'alice', 'dave', 'carol'], 'p256', workers=2)
+        self.assertEqual((created, already_existed), (['carol', 'dave'], ['alice', 'carol']))
+
+        id_manager = IdManager(self.key_dir, PASSWORD)
+        self.assertEqual(sorted(id_manager.list()), ['alice', 'bob', 'carol', 'dave'])
+        self.assertEqual(key_algorithm(id_manager.get_key('dave')), 'p256')
+
+    def test_keys_taken_from_agent_without_decrypting_again(self):
+        self._given_key_agent_running()
+        self.assertEqual(stat.S_IMODE(os.stat(join(self.key_dir, AGENT_SOCKET_FILE_NAME)).st_mode), 0o600)
+
+        with patch('client.identity_manager.serialization.load_pem_private_key', side_effect=load_pem_private_key) as load_key:
+            for _ in range(2):
+                key = IdManager(self.key_dir).get_key('alice')
+                self.assertEqual(public_key_pem(key), public_key_pem(self.id_manager.get_key('alice')))
+            self.assertEqual(load_key.call_count, 1)
+
+    def test_agent_reloads_recreated_key(self):
+        self._given_key_agent_running()
+        IdManager(self.key_dir).get_key('alice')
+        self.id_manager.delete('alice')
+        self.id_manager.create('alice', 'p256')
+
+        key = IdManager(self.key_dir).get_key('alice')
+        self.assertEqual(public_key_pem(key), public_key_pem(self.id_manager.get_key('alice')))
+
+    def test_key_read_from_file_when_agent_not_running(self):
+        open(join(self.key_dir, AGENT_SOCKET_FILE_NAME), 'w').close()
+        key = IdManager(self.key_dir, PASSWORD).get_key('bob')
+        self.assertEqual(public_key_pem(key), public_key_pem(self.id_manager.get_key('bob')))
+
+    def _given_key_agent_running(self):
+        self.key_agent = KeyAgent(self.key_dir, PASSWORD)
+        self.key_agent.start()
+        threading.Thread(target=self.key_agent.serve_forever, daemon=True).start()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,26 @@
-import unittest, os, glob, re, time, json
+import unittest, os, glob, re, time, json, shutil, requests, socket, http.client, tempfile, asyncio, base64
+from unittest.mock import patch
 from server.main import server_manager
 
+import client.main
 from client.main import process_args
-from client.server_interface import ServerInterface
+from client.server_interface import ServerInterface, AsyncServerInterface
+from client.client_cache import PublicKeyCache
+from client.replica import LocalReplica
+from client.identity_manager import IdManager
 from server.message_store import MessageStore
+from server.storage.json_file_storage import JsonFileStorage
+from server.storage.log_storage import LogStorage
+from server.server_key import ServerKey
+from server.storage.work_journal import WorkJournal
+from common.crypto_utils import sign_data_with_key
+from cryptography.hazmat.primitives import serialization
 from common.logging import get_log_messages, clear_log_messages, LogLevel
 
 BACKUP_FILE_EXT = '.bak'
-SERVER_FILE = MessageStore.file_path
+SERVER_DIR = LogStorage.dir_path
+LEGACY_SERVER_FILE = JsonFileStorage.file_path
+SERVER_KEY_FILE = ServerKey.file_path
 ID_1 = 'test1'
 ID_2 = 'test2'
 MSG_1 = 'hello'
@@ -17,6 +30,9 @@ BAD_COMMAND = 'lobster.telephone'
 def log_info(msg):
     return (LogLevel.INFO, msg)
 
+def public_key_pem(key):
+    return key.public_key().public_bytes(encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+
 class IntegrationTest(unittest.TestCase):
 
     @classmethod
@@ -31,6 +47,10 @@ class IntegrationTest(unittest.TestCase):
         clear_log_messages()
         self._delete_client_keys()
         self._delete_server_data()
+        self._delete_file_if_exists(PublicKeyCache.file_path)
+        client.main.public_key_cache = None
+        self._delete_file_if_exists(LocalReplica.file_path)
+        self._delete_file_if_exists(LocalReplica.meta_file_path)
         self._stop_server()
         ServerInterface.post_interceptor = None
 
@@ -46,8 +66,9 @@ class IntegrationTest(unittest.TestCase):
 
     @classmethod
     def _backup_server_data(cls):
-        if os.path.exists(SERVER_FILE):
-            os.rename(SERVER_FILE, SERVER_FILE + BACKUP_FILE_EXT)
+        for server_path in [SERVER_DIR, LEGACY_SERVER_FILE, SERVER_KEY_FILE]:
+            if os.path.exists(server_path):
+                os.rename(server_path, server_path + BACKUP_FILE_EXT)
 
     @classmethod
     def _restore_client_keys(cls):
@@ -56,8 +77,9 @@ class IntegrationTest(unittest.TestCase):
 
     @classmethod
     def _restore_server_data(cls):
-        if os.path.exists(SERVER_FILE + BACKUP_FILE_EXT):
-            os.rename(SERVER_FILE + BACKUP_FILE_EXT, SERVER_FILE)
+        for server_path in [SERVER_DIR, LEGACY_SERVER_FILE, SERVER_KEY_FILE]:
+            if os.path.exists(server_path + BACKUP_FILE_EXT):
+                os.rename(server_path + BACKUP_FILE_EXT, server_path)
 
     def test_unknown_client_command(self):
         self._when_unknown_command()
@@ -109,6 +131,39 @@ class IntegrationTest(unittest.TestCase):
         self._then_id_registered_message_shown_for(ID_1)
         self._then_registration_record_saved_for(ID_1)
 
+    def test_ids_with_each_key_algorithm_publish_messages(self):
+        self._start_server()
+        for id, algorithm in [(ID_1, 'ed25519'), (ID_2, 'p256')]:
+            process_args(['', 'id.create', id, algorithm])
+            self._when_register_id(id)
+            self._then_id_registered_message_shown_for(id)
+            self._when_publish_message(id, MSG_1)
+            self._then_publication_record_saved_for(id, MSG_1)
+
+        self._when_query_for(('type', 'publication'))
+        self._then_matches_found_message_is_shown_for('[{}]: {}'.format(ID_1, MSG_1), '[{}]: {}'.format(ID_2, MSG_1))
+
+    def test_ids_created_and_registered_in_bulk(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_command_run_with_lines('id.create-bulk', [ID_1, ID_2, 'test3'], 'ed25519')
+        self._assert_message_pattern_logged(r'Created 2 of 3 ids in [0-9.]+s \([0-9]+/s\), 1 failed\n- {}: already exists$'.format(ID_1))
+        self.assertEqual(sorted(IdManager().list()), [ID_1, ID_2, 'test3'])
+
+        self._when_command_run_with_lines('server.register-bulk', [ID_1, ID_2, 'test3', 'missing'])
+        self._assert_message_pattern_logged(r"Registered 3 of 4 ids in [0-9.]+s \([0-9]+/s\), 1 failed\n- missing: The id 'missing' does not exist$")
+        for id in [ID_1, ID_2, 'test3']:
+            self._then_registration_record_saved_for(id)
+
+    def test_journalled_registration_processed_when_server_starts(self):
+        self._when_create_id(ID_1)
+        request_id = self._given_registration_journalled_for(ID_1)
+
+        self._start_server()
+        status = ServerInterface('localhost', 5000).query_status(request_id, 10)
+        self.assertEqual(status['status'], 'SUCCESS')
+        self._then_registration_record_saved_for(ID_1)
+
     def test_register_id_when_server_down_server(self):
         self._when_create_id(ID_1)
         self._when_register_id(ID_1)
@@ -128,6 +183,37 @@ class IntegrationTest(unittest.TestCase):
         self._then_id_already_registered_message_shown_for(ID_1)
         self._then_registration_record_saved_for(ID_1)
 
+    def test_duplicate_registration_status_has_409_code(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        key = IdManager().get_key(ID_1)
+        server = ServerInterface('localhost', 5000)
+        self.assertEqual(server.register(ID_1, key)['code'], 200)
+        status = server.register(ID_1, key)
+        self.assertEqual((status['status'], status['code'], status['description']), ('FAILURE', 409, "The id '{}' has already been registered".format(ID_1)))
+
+    def test_status_wait_returns_when_processing_finishes(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        server = ServerInterface('localhost', 5000)
+        start = time.time()
+        status = server.register(ID_1, IdManager().get_key(ID_1))
+        self.assertEqual(status['status'], 'SUCCESS')
+        self.assertLess(time.time() - start, 1)
+
+    def test_status_stream_reports_each_request(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_create_id(ID_2)
+        server = ServerInterface('localhost', 5000)
+        request_ids = [server._sign_and_post(id, IdManager().get_key(id), 'register', {'publicKey': 'not a key'}) for id in [ID_1, ID_2]]
+
+        response = requests.get('http://localhost:5000/api/status-stream?wait=5&ids={}'.format(','.join(request_ids + ['unknown'])))
+        self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+        events = [json.loads(line[len('data: '):]) for line in response.text.splitlines() if line]
+        self.assertEqual(sorted((event['requestId'], event['status']) for event in events),
+                         sorted([(request_ids[0], 'FAILURE'), (request_ids[1], 'FAILURE'), ('unknown', 'UNKNOWN')]))
+
     def test_register_id_with_bad_signature(self):
         self._start_server()
         self._when_create_id(ID_1)
@@ -151,6 +237,61 @@ class IntegrationTest(unittest.TestCase):
         self._then_bad_signature_message_shown_for(ID_1)
         self._then_publication_record_not_saved_for(ID_1, MSG_1)
 
+    def test_publishes_batch_of_messages_to_server(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_batch(ID_1, MSG_1, MSG_2)
+        self._then_published_batch_message_shown_for(ID_1, 2)
+        self._then_publication_record_saved_for(ID_1, MSG_1)
+        self._then_publication_record_saved_for(ID_1, MSG_2)
+
+        self._when_query_for(('clientId', ID_1), ('type', 'publication'))
+        self._then_matches_found_message_is_shown_for('[{}]: {}'.format(ID_1, MSG_1), '[{}]: {}'.format(ID_1, MSG_2))
+
+    def test_publishes_batch_with_invalid_signature_to_server(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        ServerInterface.post_interceptor = self._invalidate_signature
+        self._when_publish_batch(ID_1, MSG_1, MSG_2)
+        self._then_bad_signature_message_shown_for(ID_1)
+        self._then_publication_record_not_saved_for(ID_1, MSG_1)
+        self._then_publication_record_not_saved_for(ID_1, MSG_2)
+
+    def test_hash_chain_verified(self):
+        with patch('server.main.CHECKPOINT_MESSAGES', 2):
+            self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_1)
+        self._when_publish_message(ID_1, MSG_2)
+        self._when_verify_chain()
+        self._assert_message_logged('Verified 1 hash records covering 2 of 4 records')
+
+        self._when_query_for(('clientId', ID_1))
+        self._then_matches_found_message_is_shown_for(
+            'Registration for [{}]'.format(ID_1),
+            '[{}]: {}'.format(ID_1, MSG_1),
+            '[{}]: {}'.format(ID_1, MSG_2)
+        )
+
+    def test_message_inclusion_verified(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_1)
+        self._when_publish_message(ID_1, MSG_2)
+        request_id = self._published_request_id_for(ID_1, MSG_1)
+
+        self._when_verify_message(request_id)
+        self._assert_message_logged("Message '{}' is included in the log at position 1 of 3".format(request_id))
+
+    def test_unknown_message_not_verified(self):
+        self._start_server()
+        self._when_verify_message('no-such-request')
+        self._assert_message_pattern_logged("Server rejected the request - .*No message with requestId 'no-such-request' was found")
+
     def test_query_returns_no_matches(self):
         self._start_server()
         self._when_query_for(('type', 'ographic'))
@@ -181,6 +322,109 @@ class IntegrationTest(unittest.TestCase):
         self._when_query_for(('clientId', ID_1), ('data.message', MSG_1))
         self._then_matches_found_message_is_shown_for('[{}]: {}'.format(ID_1, MSG_1))
 
+    def test_query_pages_through_results(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_1)
+        self._when_publish_message(ID_1, MSG_2)
+
+        with patch('client.server_interface.QUERY_PAGE_SIZE', 1):
+            self._when_query_for(('clientId', ID_1))
+        self._then_matches_found_message_is_shown_for(
+            'Registration for [{}]'.format(ID_1),
+            '[{}]: {}'.format(ID_1, MSG_1),
+            '[{}]: {}'.format(ID_1, MSG_2)
+        )
+
+    def test_query_only_fetches_new_messages(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_1)
+        self._when_query_for(('clientId', ID_1))
+
+        self._when_publish_message(ID_1, MSG_2)
+        fetched = self._when_query_for_counting_fetches(('clientId', ID_1))
+        self.assertEqual([msg['data']['message'] for msg in fetched], [MSG_2])
+        self._then_matches_found_message_is_shown_for(
+            'Registration for [{}]'.format(ID_1),
+            '[{}]: {}'.format(ID_1, MSG_1),
+            '[{}]: {}'.format(ID_1, MSG_2)
+        )
+
+    def test_query_fetches_public_keys_in_one_request(self):
+        self._start_server()
+        for id in [ID_1, ID_2]:
+            self._when_create_id(id)
+            self._when_register_id(id)
+            self._when_publish_message(id, MSG_1)
+
+        with patch.object(ServerInterface, 'query_messages', autospec=True, side_effect=ServerInterface.query_messages) as query_messages:
+            self._when_query_for(('type', 'publication'))
+        self.assertEqual(query_messages.call_count, 1)
+        self._then_matches_found_message_is_shown_for('[{}]: {}'.format(ID_1, MSG_1), '[{}]: {}'.format(ID_2, MSG_1))
+        with open(PublicKeyCache.file_path) as file:
+            self.assertEqual(sorted(json.load(file)['keys']), sorted([ID_1, ID_2]))
+
+    def test_query_rebuilds_replica_when_server_store_replaced(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_1)
+        self._when_query_for(('clientId', ID_1))
+
+        self._stop_server()
+        shutil.rmtree(SERVER_DIR)
+        self._start_server()
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_2)
+
+        self._when_query_for(('clientId', ID_1))
+        self._then_matches_found_message_is_shown_for('Registration for [{}]'.format(ID_1), '[{}]: {}'.format(ID_1, MSG_2))
+
+    def test_query_streams_results(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        self._when_publish_message(ID_1, MSG_1)
+
+        response = requests.get('http://localhost:5000/api/query?clientId={}&stream=1'.format(ID_1))
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['type'] for line in response.text.splitlines()], ['registration', 'publication'])
+
+    def test_connection_kept_alive_between_requests(self):
+        self._start_server()
+        with socket.create_connection(('localhost', 5000), timeout=5) as sock:
+            for _ in range(2):
+                sock.sendall(b'GET /api/query?type=registration HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                response = http.client.HTTPResponse(sock)
+                response.begin()
+                self.assertEqual(response.status, 200)
+                self.assertEqual(json.loads(response.read()), [])
+
+    def test_async_interface_publishes_concurrently(self):
+        self._start_server()
+        self._when_create_id(ID_1)
+        self._when_register_id(ID_1)
+        messages = ['msg {}'.format(n) for n in range(20)]
+
+        server = AsyncServerInterface(ServerInterface('localhost', 5000, pool_size=4))
+        try:
+            statuses = asyncio.run(server.publish_many(ID_1, IdManager().get_key(ID_1), messages))
+        finally:
+            server.close()
+
+        self.assertEqual([status['status'] for status in statuses], ['SUCCESS'] * len(messages))
+        for message in messages:
+            self._then_publication_record_saved_for(ID_1, message)
+
+    def test_idle_connection_does_not_block_other_requests(self):
+        self._start_server()
+        with socket.create_connection(('localhost', 5000), timeout=5):
+            response = requests.get('http://localhost:5000/api/query?type=registration', timeout=2)
+            self.assertEqual(response.status_code, 200)
+
     def _start_server(self):
         server_manager.start()
 
@@ -192,7 +436,9 @@ class IntegrationTest(unittest.TestCase):
             self._delete_file_if_exists(key_file)
 
     def _delete_server_data(self):
-        self._delete_file_if_exists(SERVER_FILE)
+        if os.path.exists(SERVER_DIR):
+            shutil.rmtree(SERVER_DIR)
+        self._delete_file_if_exists(SERVER_KEY_FILE)
 
     def _delete_file_if_exists(self, file):
         if os.path.exists(file):
@@ -205,6 +451,17 @@ class IntegrationTest(unittest.TestCase):
         for key in keys:
             process_args(['', 'id.create', key])
 
+    def _given_registration_journalled_for(self, id):
+        key = IdManager().get_key(id)
+        data = {'publicKey': public_key_pem(key)}
+        item = {'type': 'registration', 'requestId': 'journalled', 'clientId': id, 'publicKey': data['publicKey'],
+                'signature': base64.standard_b64encode(sign_data_with_key(data, key)).decode('utf-8'), 'data': data}
+        journal = WorkJournal()
+        journal.open()
+        journal.wait_until_durable(journal.write(item))
+        journal.close()
+        return item['requestId']
+
     def _when_unknown_command(self):
         process_args(['', BAD_COMMAND])
 
@@ -223,9 +480,48 @@ class IntegrationTest(unittest.TestCase):
     def _when_publish_message(self, id, msg):
         process_args(['', 'server.publish', id, msg])
 
+    def _when_publish_batch(self, id, *msgs):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(msgs))
+        try:
+            process_args(['', 'server.publish-batch', id, f.name])
+        finally:
+            os.remove(f.name)
+
+    def _when_command_run_with_lines(self, command, lines, *opts):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(lines))
+        try:
+            process_args(['', command, f.name, *opts])
+        finally:
+            os.remove(f.name)
+
+    def _when_verify_message(self, request_id):
+        process_args(['', 'server.verify', request_id])
+
+    def _published_request_id_for(self, id, msg):
+        messages = MessageStore(read_only=True).get_all()
+        return next(m['requestId'] for m in messages if m['type'] == 'publication' and m['clientId'] == id and m['data'] == {'message': msg})
+
+    def _when_verify_chain(self):
+        process_args(['', 'server.verify-chain'])
+
     def _when_query_for(self, *criteria):
         process_args(['', 'server.query'] + list(map(lambda p: '{}={}'.format(p[0], p[1]), criteria)))
 
+    def _when_query_for_counting_fetches(self, *criteria):
+        fetched = []
+        iter_messages = ServerInterface.iter_messages
+
+        def counting_iter_messages(server, *args):
+            for message in iter_messages(server, *args):
+                fetched.append(message)
+                yield message
+
+        with patch.object(ServerInterface, 'iter_messages', counting_iter_messages):
+            self._when_query_for(*criteria)
+        return fetched
+
     def _invalidate_signature(self, data):
         data['signature'] = data['signature'].lower()
         return data
@@ -297,6 +593,9 @@ class IntegrationTest(unittest.TestCase):
     def _then_published_message_shown_for(self, id):
         self._assert_message_pattern_logged("Publication request for id '{}' was accepted by the server \[[0-9a-f-]+\]".format(id))
 
+    def _then_published_batch_message_shown_for(self, id, count):
+        self._assert_message_logged("{} messages in 1 batches for id '{}' were accepted by the server".format(count, id))
+
     def _then_no_matches_found_message_is_shown(self):
         self._assert_message_logged("0 matches found")
 
@@ -307,12 +606,8 @@ class IntegrationTest(unittest.TestCase):
         self._assert_server_record_match_count({'type': 'publication', 'clientId': id, 'data': {'message': msg}}, 0)
 
     def _assert_server_record_match_count(self, search_criteria, expected_count):
-        if os.path.exists(SERVER_FILE):
-            with open(SERVER_FILE, 'r') as f:
-                messages = json.load(f)
-                self.assertEqual(len([msg for msg in messages if all(search_criteria[k] == msg[k] for k in search_criteria.keys())]), expected_count)
-        else:
-            self.assertEqual(expected_count, 0)
+        messages = MessageStore(read_only=True).get_all()
+        self.assertEqual(len([msg for msg in messages if all(search_criteria[k] == msg[k] for k in search_criteria.keys())]), expected_count)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import unittest, os, json, tempfile, shutil
+from os.path import join
+
+from server.storage.log_storage import LogStorage
+
+
+def build_message(n):
+    return {'type': 'publication', 'requestId': str(n), 'clientId': 'test', 'signature': '', 'data': {'message': 'msg {}'.format(n)}}
+
+
+class LogStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_dir = join(self.temp_dir, 'store')
+        self.legacy_file = join(self.temp_dir, 'store.json')
+        self.storage = None
+
+    def tearDown(self):
+        if self.storage:
+            self.storage.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_messages_are_reloaded_in_order(self):
+        self._given_storage_containing(5)
+        self._when_storage_reopened()
+        self._then_storage_contains(5)
+
+    def test_segments_are_rolled(self):
+        self._given_storage_containing(20, segment_size=200)
+        self._when_storage_reopened(segment_size=200)
+        self._then_storage_contains(20)
+        self.assertGreater(len(self._segment_files()), 1)
+
+    def test_incomplete_tail_is_discarded(self):
+        self._given_storage_containing(3)
+        self._given_partial_write_at_end_of_log()
+        self._when_storage_reopened()
+        self._then_storage_contains(3)
+        self.storage.append([build_message(3)])
+        self._when_storage_reopened()
+        self._then_storage_contains(4)
+
+    def test_read_only_storage_ignores_incomplete_tail(self):
+        self._given_storage_containing(3)
+        self._given_partial_write_at_end_of_log()
+        self._when_storage_reopened(read_only=True)
+        self._then_storage_contains(3)
+        with self.assertRaises(ValueError):
+            self.storage.append([build_message(3)])
+
+    def test_messages_read_by_offset(self):
+        self._given_storage_containing(20, segment_size=200)
+        self._when_storage_reopened(segment_size=200)
+        self._then_messages_can_be_read_by_offset(20)
+        self.storage.append([build_message(20)])
+        self._then_messages_can_be_read_by_offset(21)
+
+    def test_missing_indexes_are_rebuilt(self):
+        self._given_storage_containing(20, segment_size=200)
+        self.storage.close()
+        for file_name in self._index_files():
+            os.remove(join(self.log_dir, file_name))
+
+        self._when_storage_reopened(read_only=True)
+        self._then_messages_can_be_read_by_offset(20)
+        self.assertEqual(self._index_files(), [])
+
+        self._when_storage_reopened(segment_size=200)
+        self._then_messages_can_be_read_by_offset(20)
+        self.assertEqual(len(self._index_files()), len(self._segment_files()))
+
+    def test_index_past_end_of_log_is_corrected(self):
+        self._given_storage_containing(3)
+        self.storage.close()
+        segment_path = join(self.log_dir, self._segment_files()[-1])
+        with open(segment_path, 'r+b') as f:
+            f.truncate(os.path.getsize(segment_path) - 10)
+
+        self._when_storage_reopened()
+        self._then_storage_contains(2)
+        self.storage.append([build_message(2)])
+        self._when_storage_reopened()
+        self._then_messages_can_be_read_by_offset(3)
+
+    def test_legacy_file_is_migrated(self):
+        with open(self.legacy_file, 'w') as f:
+            json.dump([build_message(n) for n in range(4)], f, indent=4)
+        self._when_storage_reopened()
+        self._then_storage_contains(4)
+        self.assertFalse(os.path.exists(self.legacy_file))
+        self.assertTrue(os.path.exists(self.legacy_file + '.migrated'))
+
+    def _open_storage(self, **kwargs):
+        if self.storage:
+            self.storage.close()
+        self.storage = LogStorage(dir_path=self.log_dir, legacy_file_path=self.legacy_file, **kwargs)
+        self.storage.open()
+
+    def _segment_files(self):
+        return sorted(file_name for file_name in os.listdir(self.log_dir) if file_name.endswith(LogStorage.segment_extension))
+
+    def _index_files(self):
+        return sorted(file_name for file_name in os.listdir(self.log_dir) if file_name.endswith(LogStorage.index_extension))
+
+    def _given_storage_containing(self, count, **kwargs):
+        self._open_storage(**kwargs)
+        for n in range(count):
+            self.storage.append([build_message(n)])
+
+    def _given_partial_write_at_end_of_log(self):
+        self.storage.close()
+        with open(join(self.log_dir, self._segment_files()[-1]), 'ab') as f:
+            f.write(b'{"type": "publ')
+
+    def _when_storage_reopened(self, **kwargs):
+        self._open_storage(**kwargs)
+
+    def _then_storage_contains(self, count):
+        self.assertEqual(list(self.storage.load()), [build_message(n) for n in range(count)])
+
+    def _then_messages_can_be_read_by_offset(self, count):
+        self.assertEqual(self.storage.count, count)
+        for n in reversed(range(count)):
+            self.assertEqual(self.storage.read(n), build_message(n))
+
+
+if __name__ == '__main__':
+    unittest.main()
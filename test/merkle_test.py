@@ -0,0 +1,70 @@
+import unittest
+
+from common.merkle import leaf_hash, merkle_root, audit_paths, root_from_audit_path, MerkleAccumulator, MerkleTree
+
+
+def build_leaves(count):
+    return [leaf_hash(str(n).encode()) for n in range(count)]
+
+
+class MerkleTest(unittest.TestCase):
+
+    def test_audit_paths_lead_to_root(self):
+        for size in range(1, 20):
+            leaves = build_leaves(size)
+            root, paths = audit_paths(leaves)
+            self.assertEqual(root, merkle_root(leaves))
+            for index, leaf in enumerate(leaves):
+                self.assertEqual(root_from_audit_path(leaf, index, size, paths[index]), root)
+
+    def test_wrong_leaf_gives_different_root(self):
+        leaves = build_leaves(5)
+        root, paths = audit_paths(leaves)
+        self.assertNotEqual(root_from_audit_path(leaves[1], 2, 5, paths[2]), root)
+        self.assertNotEqual(root_from_audit_path(leaf_hash(b'x'), 2, 5, paths[2]), root)
+
+    def test_accumulator_root_matches_tree(self):
+        accumulator = MerkleAccumulator()
+        leaves = build_leaves(20)
+        self.assertEqual(accumulator.root(), merkle_root([]))
+        for size in range(1, len(leaves) + 1):
+            accumulator.add(leaves[size - 1])
+            self.assertEqual(accumulator.root(), merkle_root(leaves[:size]))
+
+    def test_tree_gives_proofs_for_any_size(self):
+        tree = MerkleTree()
+        leaves = build_leaves(20)
+        for leaf in leaves:
+            tree.add(leaf)
+
+        for size in range(1, len(leaves) + 1):
+            root, paths = audit_paths(leaves[:size])
+            self.assertEqual(tree.root(size), root)
+            self.assertEqual([tree.audit_path(index, size) for index in range(size)], paths)
+
+    def test_truncated_tree_matches_smaller_tree(self):
+        tree = MerkleTree()
+        leaves = build_leaves(13)
+        for leaf in leaves:
+            tree.add(leaf)
+        tree.truncate(6)
+        tree.add(leaves[12])
+
+        expected_leaves = leaves[:6] + [leaves[12]]
+        self.assertEqual(len(tree), 7)
+        self.assertEqual(tree.root(), merkle_root(expected_leaves))
+        self.assertEqual(tree.audit_path(3), audit_paths(expected_leaves)[1][3])
+
+    def test_bad_audit_path_rejected(self):
+        leaves = build_leaves(4)
+        root, paths = audit_paths(leaves)
+        with self.assertRaises(ValueError):
+            root_from_audit_path(leaves[0], 0, 4, paths[0][:1])
+        with self.assertRaises(ValueError):
+            root_from_audit_path(leaves[0], 0, 4, paths[0] + [root])
+        with self.assertRaises(ValueError):
+            root_from_audit_path(leaves[0], 4, 4, paths[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
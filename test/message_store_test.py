@@ -0,0 +1,88 @@
+import unittest, tempfile, shutil
+from os.path import join
+
+from server.message_store import MessageStore
+from server.storage.log_storage import LogStorage
+
+
+def build_registration(client_id):
+    return {'type': 'registration', 'requestId': 'r-' + client_id, 'clientId': client_id, 'signature': '', 'data': {'publicKey': 'key-' + client_id}}
+
+
+def build_publication(client_id, msg):
+    return {'type': 'publication', 'requestId': 'p-' + msg, 'clientId': client_id, 'signature': '', 'data': {'message': msg}}
+
+
+class MessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = self._open_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_indexes_are_updated_when_messages_added(self):
+        self._given_messages_added()
+        self._then_indexes_are_correct()
+
+    def test_indexes_are_rebuilt_when_store_reopened(self):
+        self._given_messages_added()
+        self.store.close()
+        self.store = self._open_store()
+        self._then_indexes_are_correct()
+
+    def test_snapshot_does_not_see_later_messages(self):
+        self.store.add(build_registration('a'))
+        snapshot = self.store.snapshot()
+        self.store.add(build_publication('a', 'one'))
+        self.store.add(build_registration('b'))
+        self.assertEqual(len(snapshot), 1)
+        self.assertEqual(list(snapshot.get_all()), [build_registration('a')])
+        self.assertEqual(snapshot.get_offsets_for_type('registration'), [0])
+        self.assertEqual(snapshot.get_offsets_for_type('publication'), [])
+        self.assertEqual(len(self.store.snapshot()), 3)
+
+    def test_batch_is_committed_together(self):
+        with self.store.batch():
+            self._given_messages_added()
+            self.assertEqual(len(self.store.snapshot()), 0)
+        self.assertEqual(len(self.store.snapshot()), 4)
+        self._then_indexes_are_correct()
+
+    def test_failed_batch_is_discarded(self):
+        self.store.add(build_registration('a'))
+        with self.assertRaises(ValueError):
+            with self.store.batch():
+                self.store.add(build_publication('a', 'one'))
+                self.store.add(build_registration('b'))
+                raise ValueError()
+        self.assertEqual(list(self.store.get_all()), [build_registration('a')])
+        self.assertIsNone(self.store.get_registration('b'))
+        self.assertEqual(self.store.get_publications('a'), [])
+        self.assertEqual(self.store.get_offsets_for_type('publication'), [])
+        self._given_messages_added()
+        self.assertEqual(len(list(self.store.get_all())), 5)
+
+    def _open_store(self):
+        return MessageStore(LogStorage(dir_path=join(self.temp_dir, 'store'), legacy_file_path=''))
+
+    def _given_messages_added(self):
+        self.store.add(build_registration('a'))
+        self.store.add(build_publication('a', 'one'))
+        self.store.add(build_registration('b'))
+        self.store.add(build_publication('a', 'two'))
+
+    def _then_indexes_are_correct(self):
+        self.assertEqual(self.store.get_registration('a'), build_registration('a'))
+        self.assertEqual(self.store.get_registration('b'), build_registration('b'))
+        self.assertIsNone(self.store.get_registration('c'))
+        self.assertEqual(self.store.get_publications('a'), [build_publication('a', 'one'), build_publication('a', 'two')])
+        self.assertEqual(self.store.get_publications('b'), [])
+        self.assertEqual(self.store.get_offsets_for_type('registration'), [0, 2])
+        self.assertEqual(self.store.get_offsets_for_type('publication'), [1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest, tempfile, shutil
+from os.path import join
+
+from server.message_store import MessageStore
+from server.query_engine import QueryEngine
+from server.storage.log_storage import LogStorage
+
+
+def build_publication(client_id, msg, extra=None):
+    return {'type': 'publication', 'requestId': 'p-{}-{}'.format(client_id, msg), 'clientId': client_id, 'signature': '', 'data': {'message': msg, 'extra': extra}}
+
+
+class QueryEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = MessageStore(LogStorage(dir_path=join(self.temp_dir, 'store'), legacy_file_path=''), indexed_paths=['data.message'])
+        self.engine = QueryEngine(self.store)
+        for client_id in ['a', 'b', 'c']:
+            for n in range(10):
+                self.store.add(build_publication(client_id, str(n), 'x' if n % 2 else 'y'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_indexed_criteria_are_intersected(self):
+        plan = self._when_query_planned(('clientId', 'b'), ('data.message', '3'))
+        self.assertEqual(list(plan.execute()), [build_publication('b', '3', 'x')])
+        self.assertEqual(plan.rows_examined, 1)
+        self.assertEqual(plan.describe(), 'index:data.message(3),clientId(10)')
+
+    def test_unindexed_criteria_are_checked_against_candidates(self):
+        plan = self._when_query_planned(('clientId', 'a'), ('data.extra', 'x'))
+        self.assertEqual([msg['data']['message'] for msg in plan.execute()], ['1', '3', '5', '7', '9'])
+        self.assertEqual(plan.rows_examined, 10)
+        self.assertEqual(plan.describe(), 'index:clientId(10);scan:data.extra')
+
+    def test_full_scan_when_no_indexes_match(self):
+        plan = self._when_query_planned(('data.extra', 'y'), ('data.missing.path', 'y'))
+        self.assertEqual(list(plan.execute()), [])
+        self.assertEqual(plan.rows_examined, 30)
+        self.assertEqual(plan.describe(), 'scan:data.extra,data.missing.path;full-scan(30)')
+
+    def test_repeated_criteria_match_any_value(self):
+        plan = self._when_query_planned(('clientId', 'a'), ('clientId', 'c'), ('data.message', '2'), ('data.extra', 'x'), ('data.extra', 'y'))
+        self.assertEqual([msg['clientId'] for msg in plan.execute()], ['a', 'c'])
+        self.assertEqual(plan.rows_examined, 2)
+        self.assertEqual(plan.describe(), 'index:data.message(3),clientId(20);scan:data.extra')
+
+    def test_no_criteria_returns_everything(self):
+        plan = self._when_query_planned()
+        self.assertEqual(len(list(plan.execute())), 30)
+
+    def _when_query_planned(self, *criteria):
+        return self.engine.plan(list(criteria))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest, tempfile, shutil, base64, time
+from os.path import join
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from common.crypto_utils import sign_data_with_key
+from server.message_store import MessageStore
+from server.request_processor import RequestProcessor, THREAD_POOL, PROCESS_POOL
+from server.storage.log_storage import LogStorage
+from server.work_queue import WorkQueue, RequestStatus
+
+ENCODING = 'utf-8'
+
+
+class RequestProcessorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = rsa.generate_private_key(backend=default_backend(), public_exponent=65537, key_size=2048)
+        cls.public_key = cls.key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode(ENCODING)
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = MessageStore(LogStorage(dir_path=join(self.temp_dir, 'store'), legacy_file_path=''))
+        self.work_queue = WorkQueue()
+        self.request_count = 0
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_items_are_stored_in_order_by_thread_pool(self):
+        self._check_items_are_stored_in_order(THREAD_POOL)
+
+    def test_items_are_stored_in_order_by_process_pool(self):
+        self._check_items_are_stored_in_order(PROCESS_POOL)
+
+    def test_items_are_stored_in_order_when_batched(self):
+        self._check_items_are_stored_in_order(THREAD_POOL, batch_size=8, batch_linger=0.05)
+
+    def test_registration_rejected_when_key_algorithm_does_not_match(self):
+        RequestProcessor(self.work_queue, self.store, 1).start()
+        request_ids = self._when_items_processed(self._registration('wrong', 'ed25519'), self._registration('right', 'rsa'))
+        self.assertEqual([self.work_queue.query(request_id) for request_id in request_ids], [RequestStatus.FAILURE, RequestStatus.SUCCESS])
+
+    def _check_items_are_stored_in_order(self, pool, batch_size=1, batch_linger=0):
+        RequestProcessor(self.work_queue, self.store, 4, pool, batch_size, batch_linger).start()
+        early_publication = self._publication('too early')
+        registration = self._registration('test')
+        duplicate_registration = self._registration('test')
+        publications = [self._publication('msg {}'.format(n)) for n in range(20)]
+        bad_publication = self._publication('bad', bad_signature=True)
+
+        request_ids = self._when_items_processed(early_publication) + \
+            self._when_items_processed(registration, *publications, duplicate_registration, bad_publication)
+
+        self.assertEqual([self.work_queue.query(request_id) for request_id in request_ids],
+                         [RequestStatus.FAILURE] + [RequestStatus.SUCCESS] * 21 + [RequestStatus.FAILURE] * 2)
+        self.assertEqual([msg['requestId'] for msg in self.store.get_all()], request_ids[1:22])
+
+    def _next_request_id(self):
+        self.request_count += 1
+        return str(self.request_count)
+
+    def _registration(self, client_id, key_algorithm=None):
+        data = {'publicKey': self.public_key}
+        if key_algorithm:
+            data['keyAlgorithm'] = key_algorithm
+        return {'type': 'registration', 'requestId': self._next_request_id(), 'clientId': client_id, 'publicKey': self.public_key,
+                'signature': self._sign(data), 'data': data}
+
+    def _publication(self, message, bad_signature=False):
+        data = {'message': message}
+        signature = self._sign({'message': 'something else'} if bad_signature else data)
+        return {'type': 'publication', 'requestId': self._next_request_id(), 'clientId': 'test', 'signature': signature, 'data': data}
+
+    def _sign(self, data):
+        return base64.standard_b64encode(sign_data_with_key(data, self.key)).decode(ENCODING)
+
+    def _when_items_processed(self, *items):
+        for item in items:
+            self.work_queue.add(item)
+        request_ids = [item['requestId'] for item in items]
+        deadline = time.time() + 30
+        while any(self.work_queue.query(request_id) == RequestStatus.PENDING for request_id in request_ids) and time.time() < deadline:
+            time.sleep(0.05)
+        return request_ids
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest, tempfile, shutil, os
+from os.path import join
+
+from common.checkpoint import verify_checkpoints
+from server.checkpoint import Checkpointer
+from server.message_store import MessageStore
+from server.storage.log_storage import LogStorage
+from server.storage.state_snapshot_storage import StateSnapshotStorage
+
+
+def build_registration(client_id):
+    return {'type': 'registration', 'requestId': 'r-' + client_id, 'clientId': client_id, 'signature': '', 'data': {'publicKey': 'key-' + client_id}}
+
+
+def build_publication(client_id, msg):
+    return {'type': 'publication', 'requestId': 'p-' + msg, 'clientId': client_id, 'signature': '', 'data': {'message': msg}}
+
+
+class RecordingLogStorage(LogStorage):
+    def load_raw(self, start=0):
+        self.load_start = start
+        return super().load_raw(start)
+
+
+class StateSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = self._open_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_only_tail_replayed_after_snapshot(self):
+        self._given_messages_added('a', 'b')
+        self.store.save_state()
+        self._given_messages_added('c')
+
+        self._when_store_reopened()
+        self.assertEqual(self.store.storage.load_start, 4)
+        self._then_store_contains('a', 'b', 'c')
+
+    def test_snapshot_saved_when_due(self):
+        self.store.close()
+        self.store = self._open_store(state_snapshot_every=4)
+        self._given_messages_added('a')
+        self.store.save_state_if_due()
+        self.assertEqual(self._snapshot_files(), [])
+
+        self._given_messages_added('b', 'c')
+        self.store.save_state_if_due()
+        self.assertEqual(self._snapshot_files(), ['{:020d}.state'.format(6)])
+
+    def test_old_snapshots_removed(self):
+        for client_id in 'abc':
+            self._given_messages_added(client_id)
+            self.store.save_state()
+        self.assertEqual(self._snapshot_files(), ['{:020d}.state'.format(4), '{:020d}.state'.format(6)])
+
+    def test_hash_chain_continues_after_snapshot(self):
+        self.store.close()
+        self.store = self._open_store(checkpointer=Checkpointer(3, 3600))
+        self._given_messages_added('a', 'b')
+        self.store.save_state()
+
+        self._when_store_reopened(checkpointer=Checkpointer(3, 3600))
+        self._given_messages_added('c', 'd')
+        self.assertEqual(verify_checkpoints(self.store.get_all()), (10, 2, 7))
+        audit_path, root = self.store.snapshot().get_inclusion_proof(0)
+        self.assertEqual(len(audit_path), 4)
+
+    def test_snapshot_ignored_when_settings_change(self):
+        self._given_messages_added('a', 'b')
+        self.store.save_state()
+
+        self._when_store_reopened(indexed_paths=['data.message'])
+        self.assertEqual(self.store.storage.load_start, 0)
+        self._then_store_contains('a', 'b')
+        self.assertEqual(self.store.get_offsets('data.message', 'b'), [3])
+
+    def test_snapshot_ignored_when_ahead_of_log(self):
+        self._given_messages_added('a', 'b')
+        self.store.save_state()
+        self.store.close()
+        for file_name in os.listdir(self._log_dir()):
+            if not file_name.endswith(StateSnapshotStorage.snapshot_extension):
+                os.remove(join(self._log_dir(), file_name))
+
+        self._when_store_reopened()
+        self.assertEqual(self.store.storage.load_start, 0)
+        self.assertEqual(list(self.store.get_all()), [])
+        self.assertIsNone(self.store.get_registration('a'))
+
+    def _log_dir(self):
+        return join(self.temp_dir, 'store')
+
+    def _open_store(self, **kwargs):
+        storage = RecordingLogStorage(dir_path=self._log_dir(), legacy_file_path='')
+        return MessageStore(storage, state_snapshots=StateSnapshotStorage(self._log_dir()), **kwargs)
+
+    def _snapshot_files(self):
+        return sorted(file_name for file_name in os.listdir(self._log_dir()) if file_name.endswith(StateSnapshotStorage.snapshot_extension))
+
+    def _given_messages_added(self, *client_ids):
+        for client_id in client_ids:
+            self.store.add(build_registration(client_id))
+            self.store.add(build_publication(client_id, client_id))
+
+    def _when_store_reopened(self, **kwargs):
+        self.store.close()
+        self.store = self._open_store(**kwargs)
+
+    def _then_store_contains(self, *client_ids):
+        expected_messages = [message for client_id in client_ids for message in [build_registration(client_id), build_publication(client_id, client_id)]]
+        self.assertEqual(list(self.store.get_all()), expected_messages)
+        for n, client_id in enumerate(client_ids):
+            self.assertEqual(self.store.get_registration(client_id), build_registration(client_id))
+            self.assertEqual(self.store.get_publications(client_id), [build_publication(client_id, client_id)])
+            self.assertEqual(self.store.get_offsets('requestId', 'p-' + client_id), [n * 2 + 1])
+        self.assertEqual(self.store.get_offsets_for_type('registration'), [n * 2 for n in range(len(client_ids))])
+
+
+if __name__ == '__main__':
+    unittest.main()
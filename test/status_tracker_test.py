@@ -0,0 +1,49 @@
+import unittest, uuid, threading, time
+from unittest.mock import patch
+
+from server.status_tracker import StatusTracker, RequestStatus, status_for_code, PENDING_CODE, SUCCESS_CODE, DUPLICATE_CODE
+
+
+class StatusTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = StatusTracker(ttl=10)
+        self.request_id = str(uuid.uuid4())
+
+    def test_status_is_updated(self):
+        self.assertIsNone(self.tracker.get(self.request_id))
+        self.tracker.set_pending(self.request_id)
+        self.assertEqual(self.tracker.get(self.request_id).code, PENDING_CODE)
+        self.tracker.complete(self.request_id, DUPLICATE_CODE, 'already registered')
+        entry = self.tracker.get(self.request_id)
+        self.assertEqual((entry.code, entry.description), (DUPLICATE_CODE, 'already registered'))
+        self.assertEqual(status_for_code(entry.code), RequestStatus.FAILURE)
+
+    def test_completed_statuses_expire(self):
+        with patch('server.status_tracker.time.monotonic', return_value=100):
+            self.tracker.set_pending('not-a-uuid')
+            self.tracker.complete(self.request_id, SUCCESS_CODE)
+
+        with patch('server.status_tracker.time.monotonic', return_value=111):
+            self.tracker.complete(str(uuid.uuid4()), SUCCESS_CODE)
+
+        self.assertIsNone(self.tracker.get(self.request_id))
+        self.assertEqual(self.tracker.get('not-a-uuid').code, PENDING_CODE)
+        self.assertEqual(len(self.tracker), 2)
+
+    def test_wait_returns_when_request_completes(self):
+        self.tracker.set_pending(self.request_id)
+        threading.Timer(0.1, lambda: self.tracker.complete(self.request_id, SUCCESS_CODE)).start()
+        start = time.monotonic()
+        self.assertEqual(self.tracker.wait(self.request_id, 10).code, SUCCESS_CODE)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.tracker.waiters, {})
+
+    def test_wait_times_out(self):
+        self.tracker.set_pending(self.request_id)
+        self.assertEqual(self.tracker.wait(self.request_id, 0.05).code, PENDING_CODE)
+        self.assertEqual(self.tracker.waiters, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest, tempfile, shutil, threading, os
+from unittest.mock import patch
+
+from server.storage.work_journal import WorkJournal
+from server.work_queue import WorkQueue, RequestStatus
+
+fsync = os.fsync
+
+
+def build_item(request_id):
+    return {'type': 'publication', 'requestId': request_id, 'clientId': 'test', 'signature': '', 'data': {'message': request_id}}
+
+
+class WorkJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_unprocessed_items_recovered_by_next_queue(self):
+        work_queue = self._open_queue()
+        for request_id in ['p1', 'p2', 'p3', 'p4']:
+            work_queue.add(build_item(request_id))
+        work_queue.process_batch(work_queue.get_batch(1, 0), lambda item: None, NoTransaction)
+
+        work_queue = self._open_queue()
+        self.assertEqual(work_queue.recover(lambda item: item['requestId'] == 'p3'), 2)
+        self.assertEqual([item['requestId'] for item in work_queue.get_batch(10, 0)], ['p2', 'p4'])
+        self.assertEqual(work_queue.query('p4'), RequestStatus.PENDING)
+        self.assertEqual(len(os.listdir(self.dir_path)), 1)
+
+    def test_incomplete_last_line_ignored(self):
+        work_queue = self._open_queue()
+        work_queue.add(build_item('p1'))
+        journal_path = os.path.join(self.dir_path, os.listdir(self.dir_path)[0])
+        with open(journal_path, 'ab') as file:
+            file.write(b'{"type": "publica')
+
+        work_queue = self._open_queue()
+        self.assertEqual(work_queue.recover(lambda item: False), 1)
+
+    def test_processed_items_released(self):
+        journal = self._open_journal(segment_size=1)
+        items = [build_item('p{}'.format(n)) for n in range(3)]
+        for item in items:
+            journal.write(item)
+        self.assertEqual(len(os.listdir(self.dir_path)), 3)
+
+        journal.complete(items[:2])
+        journal.release()
+        self.assertEqual(len(os.listdir(self.dir_path)), 1)
+
+        journal.complete(items[2:])
+        journal.release()
+        self.assertEqual(os.path.getsize(os.path.join(self.dir_path, os.listdir(self.dir_path)[0])), 0)
+        self.assertEqual(self._open_journal().recovered, [])
+
+    def test_concurrent_writers_share_syncs(self):
+        journal = self._open_journal()
+        start = threading.Barrier(20)
+
+        def write_items(n):
+            start.wait()
+            for i in range(10):
+                journal.wait_until_durable(journal.write(build_item('p{}-{}'.format(n, i))))
+
+        with patch('server.storage.work_journal.os.fsync', side_effect=fsync) as fsync_call:
+            threads = [threading.Thread(target=write_items, args=(n,)) for n in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(journal.synced_count, 200)
+        self.assertLess(fsync_call.call_count, 200)
+        self.assertEqual(len(self._open_journal().recovered), 200)
+
+    def _open_journal(self, segment_size=16 * 1024 * 1024):
+        journal = WorkJournal(self.dir_path, segment_size)
+        journal.open()
+        self.journals.append(journal)
+        return journal
+
+    def _open_queue(self):
+        journal = WorkJournal(self.dir_path)
+        self.journals.append(journal)
+        return WorkQueue(journal=journal)
+
+
+class NoTransaction:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+
+from server.exception import QueueFullError
+from server.work_queue import WorkQueue, RequestStatus
+
+
+def build_item(item_type, request_id):
+    return {'type': item_type, 'requestId': request_id}
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_queue = WorkQueue(capacity=4, high_water_mark=2)
+
+    def test_publications_rejected_at_high_water_mark(self):
+        self.work_queue.add(build_item('publication', 'p1'))
+        self.work_queue.add(build_item('publication', 'p2'))
+        with self.assertRaises(QueueFullError):
+            self.work_queue.add(build_item('publication', 'p3'))
+        self.assertEqual(self.work_queue.query('p3'), RequestStatus.UNKNOWN)
+        self.assertEqual(self.work_queue.metrics()['rejected'], 1)
+
+    def test_registrations_accepted_until_capacity(self):
+        self.work_queue.add(build_item('publication', 'p1'))
+        self.work_queue.add(build_item('publication', 'p2'))
+        self.work_queue.add(build_item('registration', 'r1'))
+        self.work_queue.add(build_item('registration', 'r2'))
+        with self.assertRaises(QueueFullError):
+            self.work_queue.add(build_item('registration', 'r3'))
+        self.assertEqual(self.work_queue.query('r2'), RequestStatus.PENDING)
+        self.assertEqual(self.work_queue.query('r3'), RequestStatus.UNKNOWN)
+
+    def test_registrations_are_taken_first(self):
+        self.work_queue = WorkQueue()
+        self.work_queue.add(build_item('publication', 'p1'))
+        self.work_queue.add(build_item('registration', 'r1'))
+        self.work_queue.add(build_item('publication', 'p2'))
+        self.work_queue.add(build_item('registration', 'r2'))
+        batch = self.work_queue.get_batch(10, 0)
+        self.assertEqual([item['requestId'] for item in batch], ['r1', 'r2', 'p1', 'p2'])
+
+        metrics = self.work_queue.metrics()
+        self.assertEqual(metrics['depth'], 0)
+        self.assertEqual(metrics['added'], 4)
+        self.assertEqual(metrics['taken'], 4)
+
+    def test_batch_statuses_set_individually(self):
+        items = [build_item('publication', 'p1'), build_item('publication', 'p2')]
+        for item in items:
+            self.work_queue.add(item)
+
+        def handler(item):
+            if item['requestId'] == 'p2':
+                raise ValueError('rejected')
+
+        self.work_queue.process_batch(self.work_queue.get_batch(10, 0), handler, NoTransaction)
+        self.assertEqual(self.work_queue.query('p1'), RequestStatus.SUCCESS)
+        self.assertEqual(self.work_queue.query('p2'), RequestStatus.FAILURE)
+
+    def test_grouped_request_ids_share_status(self):
+        item = dict(build_item('publication_batch', 'b1'), requestIds=['b1', 'm1', 'm2'])
+        self.work_queue.add(item)
+        self.assertEqual(self.work_queue.query('m2'), RequestStatus.PENDING)
+
+        self.work_queue.process_batch(self.work_queue.get_batch(10, 0), lambda item: None, NoTransaction)
+        self.assertEqual([self.work_queue.query(request_id) for request_id in ['b1', 'm1', 'm2']], [RequestStatus.SUCCESS] * 3)
+
+    def test_batch_fails_when_commit_fails(self):
+        self.work_queue.add(build_item('publication', 'p1'))
+        self.work_queue.process_batch(self.work_queue.get_batch(10, 0), lambda item: None, FailingTransaction)
+        self.assertEqual(self.work_queue.query('p1'), RequestStatus.FAILURE)
+
+
+class NoTransaction:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+
+class FailingTransaction(NoTransaction):
+    def __exit__(self, *args):
+        raise IOError('disk full')
+
+
+if __name__ == '__main__':
+    unittest.main()